@@ -0,0 +1,226 @@
+from __future__ import print_function
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import random
+import argparse
+import datetime
+import platform
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from synthetic_project import SHAPES, GOAL, generate_project
+from timing_env_pairing import write_synthetic_log
+
+RESULTS_VERSION = 1
+WEB_DATE = datetime.date(2015, 1, 1)
+DEVNULL = open(os.devnull, 'wb')
+
+# Times of plain make, only measured to subtract them.
+REFERENCE_RESULTS = ('tracking_shell.build_bash_s', 'run_workflow.noop_make_s')
+
+# float
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+# float
+def measure(cmd, cwd, env = None, prepare_fn = None):
+    if prepare_fn is not None:
+        prepare_fn()
+
+    started_at = time.time()
+    subprocess.check_call(cmd, cwd=cwd, env=env, stdout=DEVNULL, stderr=subprocess.STDOUT)
+    return time.time() - started_at
+
+# void
+def clean_build(project_dir, date):
+    for directory in (os.path.join('results', str(date)), os.path.join('logs', str(date))):
+        path = os.path.join(project_dir, directory)
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+
+# dict<str,float>
+def bench_tracking_shell(project_dir, date, targets, jobs, runs):
+    # The same build with and without the tracking shell, every recipe pays the difference.
+    make = ['make', '-j', str(jobs), GOAL, 'TODAY={}'.format(date)]
+    env = dict(os.environ, NIGHT_SHIFT_OUTPUT_MULTIPLEXER='0')
+    prepare_fn = lambda: clean_build(project_dir, date)
+
+    bash = median([ measure(make + ['SHELL=/bin/bash'], project_dir, env, prepare_fn) for _ in range(runs) ])
+    tracking_shell = median([ measure(make, project_dir, env, prepare_fn) for _ in range(runs) ])
+    env['NIGHT_SHIFT_OUTPUT_MULTIPLEXER'] = '1'
+    multiplexer = median([ measure(make, project_dir, env, prepare_fn) for _ in range(runs) ])
+
+    # The recipes of the targets and the `mkdir` of the results folder.
+    recipes = targets + 1
+    return {
+        'tracking_shell.build_bash_s': bash,
+        'tracking_shell.build_s': tracking_shell,
+        'tracking_shell.overhead_per_recipe_ms': (tracking_shell - bash) / recipes * 1000,
+        'tracking_shell.multiplexer.build_s': multiplexer,
+        'tracking_shell.multiplexer.overhead_per_recipe_ms': (multiplexer - bash) / recipes * 1000
+    }
+
+# dict<str,float>
+def bench_run_workflow(project_dir, jobs, runs):
+    # An attempt of a built project runs no recipes, the rest of its time is the wrapper's.
+    date = datetime.date.today()
+    dir_date = os.path.join(project_dir, 'logs', str(date))
+    clean_build(project_dir, date)
+    subprocess.check_call(['make', '-j', str(jobs), GOAL], cwd=project_dir, stdout=DEVNULL, stderr=subprocess.STDOUT)
+
+    # The first attempt of the day ingests the analytics, the measured ones are retries.
+    run_workflow = [os.path.join(project_dir, 'night-shift', 'lib', 'run_workflow.sh')]
+    measure(run_workflow, project_dir)
+    def prepare_fn():
+        for f in os.listdir(dir_date):
+            if f.startswith('attempt-') and f != 'attempt-00.log':
+                os.remove(os.path.join(dir_date, f))
+
+    make = median([ measure(['make', '-k', '-j', str(jobs), GOAL], project_dir) for _ in range(runs) ])
+    attempt = median([ measure(run_workflow, project_dir, prepare_fn = prepare_fn) for _ in range(runs) ])
+    return {
+        'run_workflow.noop_make_s': make,
+        'run_workflow.attempt_s': attempt,
+        'run_workflow.attempt_overhead_s': attempt - make
+    }
+
+# void
+def write_target_logs(dir_date, records, log_lines, line_bytes):
+    # One log per target of the synthetic timing log, with the marker of the tracking shell.
+    for i in range(min(records // 2, 500)):
+        target = 'results/{}/{}.csv'.format(WEB_DATE, i)
+        with io.open(os.path.join(dir_date, '{}.log'.format(target.replace('/', '_'))), 'w', encoding='utf-8') as fd:
+            fd.write(u'\n[tracking_shell {}] Working on target {} attempt 0 command \'true\'\n\n' \
+                .format(datetime.datetime.now(), target))
+            for j in range(log_lines):
+                fd.write(u'{}\n'.format(u'{} line {} '.format(target, j).ljust(line_bytes - 1, u'x')))
+
+# dict<str,float>
+def bench_web(project_dir, sizes, runs, log_lines, line_bytes):
+    # Every size gets its own date, their logs are written before the app is loaded.
+    dates = [ WEB_DATE + datetime.timedelta(days=i) for i in range(len(sizes)) ]
+    for date, records in zip(dates, sizes):
+        dir_date = os.path.join(project_dir, 'logs', str(date))
+        os.makedirs(dir_date)
+        write_synthetic_log(os.path.join(dir_date, 'timing_env.log'), records, \
+            datetime.datetime.combine(date, datetime.time(1)))
+        write_target_logs(dir_date, records, log_lines, line_bytes)
+
+    # The app takes the project directory when it is imported.
+    os.environ['NIGHT_SHIFT_PROJECT_DIR'] = project_dir
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'web'))
+    from webapp import app, TrackingShellLog
+    client = app.test_client()
+
+    results = {}
+    for date, records in zip(dates, sizes):
+        for page in ('flow', 'gantt'):
+            # The pages share the parsed timing env logs, the first request of each parses it again.
+            with TrackingShellLog.TIMING_ENV_READERS_LOCK:
+                TrackingShellLog.TIMING_ENV_READERS.clear()
+
+            timings = []
+            for _ in range(runs + 1):
+                started_at = time.time()
+                response = client.get('/{}/{}'.format(page, date))
+                response.get_data()
+                timings.append(time.time() - started_at)
+                if response.status_code != 200:
+                    raise RuntimeError('/{}/{} responded {}'.format(page, date, response.status_code))
+
+            results['web.{}.{}.cold_ms'.format(page, records)] = timings[0] * 1000
+            results['web.{}.{}.warm_ms'.format(page, records)] = median(timings[1:]) * 1000
+    return results
+
+# list<tuple<str,float,float>>
+def find_regressions(results, baseline, tolerance, min_difference):
+    regressions = []
+    for name, value in sorted(results.items()):
+        previous = baseline.get(name)
+        if previous is None or name in REFERENCE_RESULTS:
+            continue
+
+        # Every result is a time, so only the slowdowns count; the tiny ones are noise.
+        if value > previous * (1 + tolerance) and value - previous > min_difference.get(name[name.rfind('_'):], 0):
+            regressions.append((name, previous, value))
+    return regressions
+
+# void
+def save_results(path, report):
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with io.open(tmp_path, 'wb') as fd:
+        fd.write(json.dumps(report, indent=2, sort_keys=True).encode('utf-8'))
+    os.rename(tmp_path, path)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='pipeline', \
+        description="Measures the hot paths of night-shift on a synthetic project")
+    parser.add_argument('-n', '--targets', type=int, default=200, help='number of targets of the synthetic project')
+    parser.add_argument('-s', '--shape', choices=SHAPES, default='layers', help='dependency shape of the targets')
+    parser.add_argument('--log-lines', type=int, default=100, help='log lines written by each target')
+    parser.add_argument('--line-bytes', type=int, default=100, help='length of a log line')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='make jobs, 1 measures the overhead most precisely')
+    parser.add_argument('-r', '--runs', type=int, default=3, help='measured runs of each benchmark, the median is kept')
+    parser.add_argument('--records', type=int, nargs='+', default=[1000, 10000, 100000], \
+        help='timing env records of the web benchmarks')
+    parser.add_argument('--only', choices=['tracking_shell', 'run_workflow', 'web'], nargs='+', \
+        default=['tracking_shell', 'run_workflow', 'web'], help='benchmarks to run')
+    parser.add_argument('-o', '--output', help='JSON file of the results')
+    parser.add_argument('--baseline', help='JSON file of earlier results, slower results fail the run')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative slowdown to the baseline')
+    args = parser.parse_args()
+
+    random.seed(0)
+    params = dict( (name, getattr(args, name)) for name in \
+        ('targets', 'shape', 'log_lines', 'line_bytes', 'jobs', 'runs', 'records') )
+    project_dir = tempfile.mkdtemp(prefix='night-shift-bench-')
+    results = {}
+    try:
+        generate_project(project_dir, args.targets, args.shape, args.log_lines, args.line_bytes, args.jobs)
+        if 'tracking_shell' in args.only:
+            results.update(bench_tracking_shell(project_dir, datetime.date.today(), args.targets, args.jobs, args.runs))
+        if 'run_workflow' in args.only:
+            results.update(bench_run_workflow(project_dir, args.jobs, args.runs))
+        if 'web' in args.only:
+            results.update(bench_web(project_dir, args.records, args.runs, args.log_lines, args.line_bytes))
+
+    finally:
+        shutil.rmtree(project_dir)
+
+    for name, value in sorted(results.items()):
+        print('{:<55} {:>12.3f}'.format(name, value))
+
+    report = {
+        'version': RESULTS_VERSION,
+        'created_at': datetime.datetime.now().isoformat(),
+        'python': platform.python_implementation() + ' ' + platform.python_version(),
+        'platform': platform.platform(),
+        'params': params,
+        'results': results
+    }
+    if args.output:
+        save_results(args.output, report)
+
+    if args.baseline:
+        with io.open(args.baseline, 'r', encoding='utf-8') as fd:
+            baseline = json.load(fd)
+        if baseline.get('params') != params:
+            print('[!] The baseline was measured with other parameters: {}'.format(baseline.get('params')))
+
+        # Differences below these are the noise of the machine.
+        regressions = find_regressions(results, baseline['results'], args.tolerance, \
+            {'_ms': 1.0, '_s': 0.05})
+        if regressions:
+            print('\n[!] Slower than the baseline by more than {:.0%}:'.format(args.tolerance))
+            for name, previous, value in regressions:
+                print('  {}: {:.3f} -> {:.3f} ({:+.0%})'.format(name, previous, value, value / previous - 1))
+            sys.exit(1)
+
+    sys.exit(0)
@@ -0,0 +1,114 @@
+from __future__ import print_function
+import os
+import io
+import re
+import random
+import argparse
+import datetime
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+SHAPES = ('flat', 'chain', 'tree', 'layers')
+GOAL = 'benchmark'
+
+# list<list<int>>
+def get_prerequisites(targets, shape, width = 10, fan_in = 2, seed = 0):
+    rnd = random.Random(seed)
+    prerequisites = []
+    for i in range(targets):
+        if shape == 'chain':
+            prerequisites.append([i - 1] if i else [])
+        elif shape == 'tree':
+            prerequisites.append([(i - 1) // 2] if i else [])
+        elif shape == 'layers':
+            # Every target depends on a few random targets of the previous layer.
+            layer = i // width
+            previous = list(range((layer - 1) * width, layer * width)) if layer else []
+            prerequisites.append(sorted(rnd.sample(previous, min(fan_in, len(previous)))))
+        else:
+            prerequisites.append([])
+    return prerequisites
+
+# str
+def get_target(i):
+    return 'results/$(TODAY)/t{:06d}'.format(i)
+
+# str
+def get_recipe(i, log_lines, line_bytes):
+    if not log_lines:
+        return 'touch $@'
+
+    # `seq` writes the log without a pipe, so `pipefail` of the tracking shell never trips on it.
+    line = 'target {:06d} line %g '.format(i)
+    return "seq -f '{}{}' {} && touch $@".format(line, 'x' * max(line_bytes - len(line) - 8, 0), log_lines)
+
+# str
+def get_makefile(targets, shape, log_lines, line_bytes, width = 10, fan_in = 2, seed = 0):
+    lines = [
+        '# Synthetic project of night-shift/benchmarks/synthetic_project.py',
+        'include night-shift/lib/boilerplate.mk',
+        '',
+        'scaffold:: results/$(TODAY)/',
+        'results/$(TODAY)/:',
+        '\tmkdir -p $@',
+        '',
+        '.PHONY: {}'.format(GOAL),
+        '{}: scaffold {}'.format(GOAL, ' '.join( get_target(i) for i in range(targets) )),
+        ''
+    ]
+    for i, prerequisites in enumerate(get_prerequisites(targets, shape, width, fan_in, seed)):
+        lines.append('{}: {}| results/$(TODAY)/'.format(get_target(i), \
+            ''.join( '{} '.format(get_target(p)) for p in prerequisites )))
+        lines.append('\t{}'.format(get_recipe(i, log_lines, line_bytes)))
+    return '\n'.join(lines) + '\n'
+
+# str
+def get_config(jobs, max_attempts = 23):
+    overrides = {
+        'NIGHT_SHIFT_TARGETS': GOAL,
+        'NIGHT_SHIFT_FAILURE_TARGETS': 'backup',
+        'NIGHT_SHIFT_PARALLEL_JOBS': str(jobs),
+        'NIGHT_SHIFT_MAX_ATTEMPTS': str(max_attempts)
+    }
+    with io.open(os.path.join(ROOT_DIR, 'config', 'night_shift.sh.sample'), 'r', encoding='utf-8') as fd:
+        config = fd.read()
+
+    for name, value in overrides.items():
+        config = re.sub(r'(?m)^export {}=.*$'.format(name), u'export {}="{}"'.format(name, value), config)
+    return config
+
+# void
+def generate_project(project_dir, targets, shape = 'flat', log_lines = 10, line_bytes = 100, jobs = 1, \
+        width = 10, fan_in = 2, seed = 0, date = None):
+    date = date or datetime.date.today()
+    for directory in ('config', os.path.join('logs', str(date)), os.path.join('results', str(date))):
+        if not os.path.isdir(os.path.join(project_dir, directory)):
+            os.makedirs(os.path.join(project_dir, directory))
+
+    # The project uses this checkout, like a submodule.
+    link = os.path.join(project_dir, 'night-shift')
+    if not os.path.lexists(link):
+        os.symlink(os.path.abspath(ROOT_DIR), link)
+
+    with io.open(os.path.join(project_dir, 'Makefile'), 'w', encoding='utf-8') as fd:
+        fd.write(u'{}'.format(get_makefile(targets, shape, log_lines, line_bytes, width, fan_in, seed)))
+    with io.open(os.path.join(project_dir, 'config', 'night_shift.sh'), 'w', encoding='utf-8') as fd:
+        fd.write(get_config(jobs))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='synthetic_project', \
+        description="Generates a night-shift project with synthetic targets")
+    parser.add_argument('project_dir', help='directory of the project')
+    parser.add_argument('-n', '--targets', type=int, default=100, help='number of targets')
+    parser.add_argument('-s', '--shape', choices=SHAPES, default='flat', help='dependency shape of the targets')
+    parser.add_argument('--width', type=int, default=10, help='targets per layer of the layers shape')
+    parser.add_argument('--fan-in', type=int, default=2, help='prerequisites per target of the layers shape')
+    parser.add_argument('--log-lines', type=int, default=10, help='log lines written by each target')
+    parser.add_argument('--line-bytes', type=int, default=100, help='length of a log line')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='NIGHT_SHIFT_PARALLEL_JOBS of the project')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random dependencies')
+    args = parser.parse_args()
+
+    generate_project(args.project_dir, args.targets, args.shape, args.log_lines, args.line_bytes, args.jobs, \
+        args.width, args.fan_in, args.seed)
+    print('Generated {} {} targets into {}, build them with `make {}`.'.format(args.targets, args.shape, \
+        args.project_dir, GOAL))
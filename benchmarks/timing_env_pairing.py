@@ -0,0 +1,110 @@
+from __future__ import print_function
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import random
+import argparse
+import datetime
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'lib'))
+from timing_env import TimingEnvLogReader
+
+# void
+def write_synthetic_log(path, records, started_at = datetime.datetime(2015, 1, 1, 1)):
+    with io.open(path, 'w', encoding='utf-8') as fd:
+        running = []
+        for i in range(records // 2):
+            started_at += datetime.timedelta(milliseconds=random.randint(1, 2000))
+            data = {
+                'command': 'night-shift/lib/run_sql_template.rb script/{}.erb.sql'.format(i % 500),
+                'target': 'results/2015-01-01/{}.csv'.format(i % 500),
+                'unique_nr': random.randint(0, 1000000),
+                'has_make_level': True,
+                'started_at': started_at.isoformat(),
+                'tag': 'BEGIN'
+            }
+            fd.write(u"{}\n".format(json.dumps(data)))
+            running.append(dict(data))
+
+            # Keep a few commands running on parallel, like `make -j`.
+            if len(running) > 6:
+                data = running.pop(random.randint(0, len(running)-1))
+                data.update({
+                    'tag': 'END',
+                    'finished_at': (started_at + datetime.timedelta(seconds=1)).isoformat(),
+                    'exit_code': 0
+                })
+                fd.write(u"{}\n".format(json.dumps(data)))
+
+# tuple<list<dict>,set<str>>
+def legacy_find_timing_env_commands(path):
+    from dateutil.parser import parse as parse_datetime
+    content = io.open(path, 'r', encoding='utf-8').read()
+
+    commands, ordered_commands, errors = {}, [], set()
+    for line in content.split('\n'):
+        try:
+            data = json.loads(line)
+        except:
+            continue
+
+        # `dict.keys()` is a list on Python 2, emulate its linear lookup.
+        keys = commands.keys() if sys.version_info[0] == 2 else list(commands.keys())
+        cmd_hash_key = (data['command'],data['unique_nr'])
+        if cmd_hash_key not in keys and data['tag'] == 'BEGIN':
+            commands[cmd_hash_key] = data
+            commands[cmd_hash_key]['tags'] = [data['tag']]
+            ordered_commands.append(commands[cmd_hash_key])
+
+        elif cmd_hash_key in keys and data['tag'] in commands[cmd_hash_key]['tags']:
+            errors.add('Found duplicated command: {}'.format(data['command']))
+
+        elif cmd_hash_key in keys and data['tag'] == 'END':
+            commands[cmd_hash_key].update(data)
+            commands[cmd_hash_key]['tags'].append(data['tag'])
+
+        else:
+            errors.add('Unknown error: {}'.format(data['command']))
+
+    for command in ordered_commands:
+        command['started_at'] = parse_datetime(command['started_at'])
+        if 'finished_at' in command: command['finished_at'] = parse_datetime(command['finished_at'])
+
+    return ordered_commands, errors
+
+# float
+def measure(fn, *args):
+    started_at = time.time()
+    fn(*args)
+    return time.time() - started_at
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='timing_env_pairing', \
+        description="Compares the legacy and the incremental timing env log parser")
+    parser.add_argument('-n', '--records', type=int, default=100000, help='number of synthetic records')
+    parser.add_argument('--skip-legacy', action='store_true', help='do not run the legacy parser')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'timing_env.log')
+        write_synthetic_log(path, args.records)
+        print('Synthetic log: {} records, {} bytes'.format(args.records, os.path.getsize(path)))
+
+        if not args.skip_legacy:
+            print('legacy parser:      {:.3f}s'.format(measure(legacy_find_timing_env_commands, path)))
+
+        reader = TimingEnvLogReader(path)
+        print('pairing engine:     {:.3f}s'.format(measure(reader.read)))
+
+        write_synthetic_log(path + '.tail', 100, datetime.datetime(2015, 1, 2, 1))
+        with io.open(path, 'ab') as fd:
+            fd.write(io.open(path + '.tail', 'rb').read())
+        print('refresh +100 lines: {:.3f}s'.format(measure(reader.read)))
+
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,64 @@
+from __future__ import print_function
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+TRACKING_SHELL = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'lib', 'tracking_shell.py')
+DATE = '2015-01-01'
+
+# float
+def measure(cmd, runs, cwd, env = None):
+    started_at = time.time()
+    for _ in range(runs):
+        subprocess.check_call(cmd, cwd=cwd, env=env)
+    return (time.time() - started_at) / runs
+
+# list<tuple<int,str>>
+def get_import_times(cwd):
+    # `-X importtime` is available since Python 3.7.
+    process = subprocess.Popen([sys.executable, '-X', 'importtime', TRACKING_SHELL, '--target', 'no-target', \
+        '--date', DATE, '-c', 'true'], cwd=cwd, stderr=subprocess.PIPE, universal_newlines=True)
+    _, stderr = process.communicate()
+
+    import_times = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line.split(':', 1)[1].split('|')
+        if not module.startswith('  '):
+            import_times.append((int(cumulative), module.strip()))
+    return sorted(import_times, reverse=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='tracking_shell_startup', \
+        description="Measures the per-recipe overhead of the tracking shell")
+    parser.add_argument('-n', '--runs', type=int, default=50, help='number of invocations')
+    parser.add_argument('--top', type=int, default=10, help='number of top level imports to show')
+    args = parser.parse_args()
+
+    project_dir = tempfile.mkdtemp()
+    try:
+        os.makedirs(os.path.join(project_dir, 'logs', DATE))
+        env = dict(os.environ, MAKELEVEL='1')
+
+        bash = measure(['/bin/bash', '-c', 'true'], args.runs, project_dir)
+        interpreter = measure([sys.executable, '-c', 'pass'], args.runs, project_dir)
+        tracking_shell = measure([sys.executable, TRACKING_SHELL, '--target', 'results/{}/x'.format(DATE), \
+            '--date', DATE, '-c', 'true'], args.runs, project_dir, env)
+
+        print('/bin/bash -c true:   {:.1f}ms'.format(bash * 1000))
+        print('empty interpreter:   {:.1f}ms'.format(interpreter * 1000))
+        print('tracking shell:      {:.1f}ms'.format(tracking_shell * 1000))
+        print('overhead per recipe: {:.1f}ms'.format((tracking_shell - bash) * 1000))
+
+        if sys.version_info >= (3, 7):
+            print('\nSlowest top level imports:')
+            for cumulative, module in get_import_times(project_dir)[:args.top]:
+                print('  {:>8.1f}ms {}'.format(cumulative / 1000.0, module))
+
+    finally:
+        shutil.rmtree(project_dir)
@@ -0,0 +1,224 @@
+#!/usr/bin/env pypy
+
+from __future__ import print_function
+import os
+import re
+import sys
+import sqlite3
+import argparse
+import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from timing_env import TimingEnvLogReader, normalize_target
+
+DATABASE_NAME = 'analytics.sqlite'
+
+RE_DIR_DATE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+# Columns of the commands table, in the order of the rows.
+COMMAND_COLUMNS = ['date', 'target', 'command', 'unique_nr', 'attempt_nr', 'has_make_level', 'started_at', \
+    'finished_at', 'duration', 'exit_code', 'output_bytes', 'cpu_user', 'cpu_sys', 'max_rss_kb', \
+    'read_bytes', 'write_bytes']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS days (
+    date TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    ingested_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS commands (
+    date TEXT NOT NULL,
+    target TEXT NOT NULL,
+    command TEXT NOT NULL,
+    unique_nr TEXT,
+    attempt_nr INTEGER NOT NULL,
+    has_make_level INTEGER NOT NULL,
+    started_at TEXT NOT NULL,
+    finished_at TEXT,
+    duration REAL,
+    exit_code INTEGER,
+    output_bytes INTEGER,
+    cpu_user REAL,
+    cpu_sys REAL,
+    max_rss_kb INTEGER,
+    read_bytes INTEGER,
+    write_bytes INTEGER
+);
+CREATE INDEX IF NOT EXISTS commands_target ON commands (target, date);
+CREATE INDEX IF NOT EXISTS commands_date ON commands (date);
+"""
+
+# float
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+
+    # Linear interpolation between the closest ranks.
+    rank = (len(sorted_values) - 1) * p / 100.0
+    lower = int(rank)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (rank - lower)
+
+# float
+def median(sorted_values):
+    return percentile(sorted_values, 50)
+
+class AnalyticsStore(object):
+    PERCENTILES = (50, 90, 99)
+
+    # void
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(SCHEMA)
+
+    # AnalyticsStore
+    def __enter__(self):
+        return self
+
+    # void
+    def __exit__(self, *args):
+        self.close()
+
+    # void
+    def close(self):
+        self.connection.close()
+
+    # bool
+    def is_ingested(self, date, stat):
+        row = self.connection.execute('SELECT size, mtime FROM days WHERE date = ?', (date,)).fetchone()
+        return row is not None and row['size'] == stat.st_size and row['mtime'] == stat.st_mtime
+
+    # tuple
+    def get_command_row(self, date, command):
+        finished = 'finished_at' in command
+        return (
+            date,
+            normalize_target(command['target'], date),
+            command['command'],
+            str(command.get('unique_nr')),
+            command['attempt_nr'],
+            int(bool(command.get('has_make_level'))),
+            command['started_at'].isoformat(),
+            command['finished_at'].isoformat() if finished else None,
+            command['length'] * 60 if finished else None,
+            command.get('exit_code') if finished else None,
+            command.get('output_bytes'),
+            command.get('cpu_user'),
+            command.get('cpu_sys'),
+            command.get('max_rss_kb'),
+            command.get('read_bytes'),
+            command.get('write_bytes')
+        )
+
+    # int
+    def ingest_day(self, dir_date, force = False):
+        date = os.path.basename(os.path.normpath(dir_date))
+        path = os.path.join(dir_date, 'timing_env.log')
+        if not os.path.exists(path):
+            return 0
+
+        stat = os.stat(path)
+        if not force and self.is_ingested(date, stat):
+            return 0
+
+        commands, _ = TimingEnvLogReader(path).read()
+        rows = [ self.get_command_row(date, command) for command in commands ]
+
+        # A day is replaced as a whole, so ingesting it again is harmless.
+        with self.connection:
+            self.connection.execute('DELETE FROM commands WHERE date = ?', (date,))
+            self.connection.executemany('INSERT INTO commands ({}) VALUES ({})'.format( \
+                ','.join(COMMAND_COLUMNS), ','.join('?' * len(COMMAND_COLUMNS))), rows)
+            self.connection.execute('INSERT OR REPLACE INTO days VALUES (?,?,?,?)', \
+                (date, stat.st_size, stat.st_mtime, datetime.datetime.now().isoformat()))
+
+        return len(rows)
+
+    # list<tuple<str,int>>
+    def ingest_logs(self, dir_logs, until = None, force = False):
+        until = until or datetime.date.today()
+        ingested = []
+        for date in sorted(os.listdir(dir_logs)):
+            # The current day is still written, it is ingested when it is finished.
+            if not RE_DIR_DATE.match(date) or date >= str(until):
+                continue
+
+            rows = self.ingest_day(os.path.join(dir_logs, date), force)
+            if rows:
+                ingested.append((date, rows))
+        return ingested
+
+    # list<str>
+    def get_dates(self):
+        return [ row['date'] for row in self.connection.execute('SELECT date FROM days ORDER BY date') ]
+
+    # list<dict>
+    def get_duration_history(self, target, since = None):
+        rows = self.connection.execute("""
+            SELECT date, attempt_nr, started_at, duration, exit_code, output_bytes,
+                cpu_user, cpu_sys, max_rss_kb, read_bytes, write_bytes
+            FROM commands
+            WHERE target = ? AND date >= ? AND has_make_level = 1
+            ORDER BY date, started_at
+        """, (target, str(since or ''))).fetchall()
+        return [ dict(row) for row in rows ]
+
+    # dict
+    def get_duration_stats(self, durations):
+        durations = sorted(durations)
+        stats = dict( ('p{}'.format(p), percentile(durations, p)) for p in self.PERCENTILES )
+        stats.update({'runs': len(durations), 'max': durations[-1] if durations else None})
+        return stats
+
+    # list<dict>
+    def get_target_stats(self, since = None, recent_since = None):
+        rows = self.connection.execute("""
+            SELECT target, date, duration, cpu_user + cpu_sys AS cpu, max_rss_kb
+            FROM commands
+            WHERE date >= ? AND has_make_level = 1 AND exit_code = 0 AND duration IS NOT NULL
+            ORDER BY target
+        """, (str(since or ''),))
+
+        durations, cpu_times, max_rss = {}, {}, {}
+        for row in rows:
+            recent = recent_since is not None and row['date'] >= str(recent_since)
+            durations.setdefault(row['target'], ([], []))[int(recent)].append(row['duration'])
+            if row['cpu'] is not None:
+                cpu_times.setdefault(row['target'], []).append(row['cpu'])
+                max_rss[row['target']] = max(max_rss.get(row['target'], 0), row['max_rss_kb'])
+
+        target_stats = []
+        for target in sorted(durations):
+            baseline, recent = durations[target]
+            stats = self.get_duration_stats(baseline + recent)
+            baseline_median, recent_median = median(sorted(baseline)), median(sorted(recent))
+            stats.update({
+                'target': target,
+                'cpu_p50': median(sorted(cpu_times.get(target, []))),
+                'max_rss_kb': max_rss.get(target),
+                'recent_p50': recent_median,
+                'change': (recent_median - baseline_median) / baseline_median \
+                    if baseline_median and recent_median is not None else None
+            })
+            target_stats.append(stats)
+
+        return target_stats
+
+# str
+def get_database_path(dir_logs):
+    return os.path.join(dir_logs, DATABASE_NAME)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='analytics', \
+        description="Ingests the timing env logs of finished dates into an SQLite store")
+    parser.add_argument('logs', nargs='?', default='logs', help='log directory of the project')
+    parser.add_argument('-db', '--database', help='path of the store, default: <logs>/{}'.format(DATABASE_NAME))
+    parser.add_argument('-f', '--force', action='store_true', help='ingest the unchanged dates again')
+    args = parser.parse_args()
+
+    with AnalyticsStore(args.database or get_database_path(args.logs)) as store:
+        for date, rows in store.ingest_logs(args.logs, force = args.force):
+            print('Ingested {} commands of {}'.format(rows, date))
@@ -18,7 +18,8 @@ endif
 TMP_OUT=$@.$(TMP_TOKEN).tmp
 
 # Define the tracking shell (you can redefine it in your Makefile).
-SHELL=./night-shift/lib/tracking_shell.py --target $@ --date $(TODAY)
+# Targets can declare a limited resource, e.g. `results/x.csv: RESOURCE=redshift`.
+SHELL=./night-shift/lib/tracking_shell.py --target $@ --date $(TODAY)$(if $(RESOURCE), --resource $(RESOURCE))
 
 .PHONY: all nuke scaffold backup clean-test cleanup
 
@@ -0,0 +1,256 @@
+#!/usr/bin/env pypy
+
+from __future__ import print_function
+import os
+import io
+import re
+import sys
+import json
+import argparse
+import datetime
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from timing_env import TimingEnvLogReader
+
+GRAPH_FILE_NAME = 'make_graph.json'
+
+RE_RULE = re.compile(r'^([^\s#][^:]*?)(::?)(?!=)\s*(.*)$')
+RE_ASSIGNMENT = re.compile(r'^\S*\s*(?:::|[:+?!])?=')
+
+# Width of one utilization bucket in seconds, the gantt draws one pixel per minute.
+BUCKET_SIZE = 60
+
+# dict<str,list<str>>
+def parse_make_database(lines):
+    graph, in_files, is_target = {}, False, True
+    for line in lines:
+        line = line.rstrip('\n')
+        if line == '# Files':
+            in_files = True
+        elif line.startswith('# files hash-table stats'):
+            in_files = False
+        elif line == '# Not a target:':
+            is_target = False
+
+        if not in_files or not line or line.startswith(('#', '\t', ' ')):
+            continue
+
+        match = RE_RULE.match(line)
+        if not match or RE_ASSIGNMENT.match(match.group(3)):
+            continue
+
+        if is_target and not match.group(1).startswith('.'):
+            # Order-only prerequisites have to be finished before the target as well.
+            prerequisites = match.group(3).replace('|', ' ').split()
+            for target in match.group(1).split():
+                graph.setdefault(target, [])
+                graph[target].extend(p for p in prerequisites if p not in graph[target])
+        is_target = True
+
+    return graph
+
+# dict<str,list<str>>
+def get_reachable_graph(graph, targets):
+    reachable, stack = {}, list(targets)
+    while stack:
+        target = stack.pop()
+        # Prerequisites without a rule are source files, not targets.
+        if target not in reachable and target in graph:
+            reachable[target] = graph[target]
+            stack.extend(reachable[target])
+    return reachable
+
+# list<str>
+def read_make_database(date, targets, makefile = None):
+    cmd = ['make', '-pnk', 'TODAY={}'.format(date), 'SHELL=/bin/bash']
+    if makefile:
+        cmd.extend(['-f', makefile])
+
+    with open(os.devnull, 'w') as devnull:
+        process = subprocess.Popen(cmd + list(targets), stdout=subprocess.PIPE, stderr=devnull)
+        lines = [ line.decode('utf-8', 'replace') for line in process.stdout ]
+        process.wait()
+    return lines
+
+# dict<str,dict>
+def get_target_timings(commands):
+    # Every recipe line is a command, the last attempt of each one counts.
+    last_commands = {}
+    for cmd in commands:
+        if cmd.get('has_make_level') and 'finished_at' in cmd:
+            last_commands[(cmd['target'], cmd['command'])] = cmd
+
+    timings = {}
+    for (target, _), cmd in last_commands.items():
+        timing = timings.setdefault(target, {'duration': 0.0, 'started_at': cmd['started_at'], \
+            'finished_at': cmd['finished_at']})
+        timing['duration'] += cmd['length'] * 60
+        timing['started_at'] = min(timing['started_at'], cmd['started_at'])
+        timing['finished_at'] = max(timing['finished_at'], cmd['finished_at'])
+    return timings
+
+# list<str>
+def get_topological_order(graph):
+    order, state = [], {}
+    for root in sorted(graph):
+        if root in state:
+            continue
+
+        state[root] = 'visiting'
+        stack = [(root, iter(graph[root]))]
+        while stack:
+            node, prerequisites = stack[-1]
+            for prerequisite in prerequisites:
+                # Circular dependencies are dropped by make as well.
+                if prerequisite not in state:
+                    state[prerequisite] = 'visiting'
+                    stack.append((prerequisite, iter(graph.get(prerequisite, []))))
+                    break
+            else:
+                stack.pop()
+                state[node] = 'done'
+                order.append(node)
+    return order
+
+# dict
+def analyze_critical_path(graph, timings):
+    graph = dict(graph)
+    for target in timings:
+        graph.setdefault(target, [])
+
+    order = get_topological_order(graph)
+    durations = dict( (target, timings[target]['duration'] if target in timings else 0.0) for target in order )
+
+    earliest_finish, parents = {}, {}
+    for target in order:
+        earliest_start, parent = 0.0, None
+        for prerequisite in graph.get(target, []):
+            if prerequisite in earliest_finish and (parent is None or earliest_finish[prerequisite] > earliest_start):
+                earliest_start, parent = earliest_finish[prerequisite], prerequisite
+        earliest_finish[target], parents[target] = earliest_start + durations[target], parent
+
+    length = max(earliest_finish.values()) if earliest_finish else 0.0
+    latest_finish = dict( (target, length) for target in order )
+    for target in reversed(order):
+        latest_start = latest_finish[target] - durations[target]
+        for prerequisite in graph.get(target, []):
+            if prerequisite in latest_finish:
+                latest_finish[prerequisite] = min(latest_finish[prerequisite], latest_start)
+
+    path, target = [], max(order, key = lambda t: earliest_finish[t]) if order else None
+    while target is not None:
+        if durations[target] > 0:
+            path.append(target)
+        target = parents.get(target)
+
+    return {
+        'length': length,
+        'path': list(reversed(path)),
+        'targets': dict( (target, {
+            'duration': durations[target],
+            'earliest_start': earliest_finish[target] - durations[target],
+            'slack': latest_finish[target] - earliest_finish[target],
+            'prerequisites': graph.get(target, [])
+        }) for target in order )
+    }
+
+# dict
+def analyze_utilization(commands, jobs, bucket_size = BUCKET_SIZE):
+    intervals = [ (cmd['started_at'], cmd['finished_at']) for cmd in commands \
+        if cmd.get('has_make_level') and 'finished_at' in cmd ]
+    if not intervals:
+        return {'jobs': jobs, 'average': None, 'window': 0.0, 'buckets': []}
+
+    started_at = min(start for start, _ in intervals)
+    window = (max(end for _, end in intervals) - started_at).total_seconds()
+
+    # Busy slot seconds of each bucket, divided by the bucket length later.
+    busy = [0.0] * (int(window // bucket_size) + 1)
+    for start, end in intervals:
+        start, end = (start - started_at).total_seconds(), (end - started_at).total_seconds()
+        while start < end:
+            bucket = int(start // bucket_size)
+            bucket_end = min(end, (bucket + 1) * bucket_size)
+            busy[bucket] += bucket_end - start
+            start = bucket_end
+
+    return {
+        'jobs': jobs,
+        'started_at': started_at.isoformat(),
+        'window': window,
+        'average': sum(busy) / (jobs * window) if window else None,
+        'buckets': [ round(seconds / bucket_size, 3) for seconds in busy ]
+    }
+
+# dict
+def analyze(date, commands, graph, jobs):
+    timings = get_target_timings(commands)
+    critical_path = analyze_critical_path(graph, timings)
+    for target, timing in timings.items():
+        critical_path['targets'][target].update({
+            'started_at': timing['started_at'].isoformat(),
+            'finished_at': timing['finished_at'].isoformat()
+        })
+
+    return {
+        'date': str(date),
+        'critical_path': critical_path['path'],
+        'critical_path_length': critical_path['length'],
+        'targets': critical_path['targets'],
+        'utilization': analyze_utilization(commands, jobs)
+    }
+
+# void
+def save_analysis(path, analysis):
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with io.open(tmp_path, 'wb') as fd:
+        fd.write(json.dumps(analysis, sort_keys=True).encode('utf-8'))
+    os.rename(tmp_path, path)
+
+# void
+def print_analysis(analysis):
+    utilization = analysis['utilization']
+    print('Critical path: {:.1f}m'.format(analysis['critical_path_length'] / 60))
+    for target in analysis['critical_path']:
+        print('  {:8.1f}m  {}'.format(analysis['targets'][target]['duration'] / 60, target))
+
+    if utilization['average'] is not None:
+        print('Window: {:.1f}m, slot utilization: {:.0%} of {} jobs'.format(
+            utilization['window'] / 60, utilization['average'], utilization['jobs']))
+
+    slack = sorted(( (info['slack'], target) for target, info in analysis['targets'].items() \
+        if info['duration'] > 0 and info['slack'] > 0 ), reverse = True)
+    if slack:
+        print('Most slack:')
+        for seconds, target in slack[:10]:
+            print('  {:8.1f}m  {}'.format(seconds / 60, target))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='critical_path', \
+        description="Computes the critical path, slack and job slot utilization of a nightly run")
+    parser.add_argument('targets', nargs='*', help='make targets of the run, e.g. $NIGHT_SHIFT_TARGETS')
+    parser.add_argument('-d', '--date', default=str(datetime.date.today()), help='date of the run')
+    parser.add_argument('-j', '--jobs', type=int, default=int(os.environ.get('NIGHT_SHIFT_PARALLEL_JOBS', 6)), \
+        help='number of parallel jobs')
+    parser.add_argument('-f', '--makefile', help='makefile of the project')
+    parser.add_argument('-p', '--database', type=argparse.FileType('r'), \
+        help='saved `make -pn` output instead of running make')
+    parser.add_argument('-q', '--quiet', action='store_true', help='only write {}'.format(GRAPH_FILE_NAME))
+    args = parser.parse_args()
+
+    dir_date = os.path.join('logs', args.date)
+    commands, _ = TimingEnvLogReader(os.path.join(dir_date, 'timing_env.log')).read()
+    lines = args.database.readlines() if args.database else \
+        read_make_database(args.date, args.targets, args.makefile)
+
+    graph = parse_make_database(lines)
+    if args.targets:
+        graph = get_reachable_graph(graph, args.targets)
+
+    analysis = analyze(args.date, commands, graph, args.jobs)
+    if os.path.isdir(dir_date):
+        save_analysis(os.path.join(dir_date, GRAPH_FILE_NAME), analysis)
+
+    if not args.quiet:
+        print_analysis(analysis)
@@ -0,0 +1,436 @@
+#!/usr/bin/env pypy
+
+# Runs the recipes of the tracking shell on worker hosts.
+
+# With `NIGHT_SHIFT_EXECUTOR` the tracking shell submits each recipe to the
+# coordinator and waits for it, so make still decides what runs and when. The
+# workers pull the recipes, run them in the project directory (shared with the
+# make host, e.g. over NFS) and stream their output back to the tracking shell,
+# which writes the target log and the timing records as before.
+# Every message is a JSON line over TCP, the first one of a connection carries the
+# shared secret of `NIGHT_SHIFT_EXECUTOR_TOKEN`.
+
+from __future__ import print_function
+import os
+import io
+import sys
+import hmac
+import json
+import time
+import base64
+import binascii
+import signal
+import socket
+import argparse
+import datetime
+import tempfile
+import threading
+import subprocess
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+DEFAULT_PORT = 7010
+OUTPUT_BUFFER_SIZE = 64 * 1024
+RECONNECT_INTERVAL = 1.0
+MAX_RECONNECT_INTERVAL = 30.0
+
+# A lost host or network is noticed within a minute instead of the two hours of the
+# system's keepalive, a recipe may run for hours without any output.
+KEEPALIVE_IDLE = 30
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 3
+
+# Exit code of a recipe whose worker or coordinator was lost.
+LOST_EXIT_CODE = 255
+
+# Environment of the recipe sent to the workers, the rest comes from the worker's own.
+FORWARDED_ENV = ('ATTEMPT_COUNT', 'PYTHONPATH', 'RUBYOPT')
+FORWARDED_ENV_PREFIX = 'NIGHT_SHIFT_'
+# A recipe calling the tracking shell again (e.g. a sub-make) runs on its worker.
+LOCAL_ENV = ('NIGHT_SHIFT_EXECUTOR', 'NIGHT_SHIFT_EXECUTOR_TOKEN')
+
+# tuple<str,int>
+def parse_address(address):
+    if ':' not in address:
+        return address, DEFAULT_PORT
+
+    host, port = address.rsplit(':', 1)
+    return host or 'localhost', int(port)
+
+# dict<str,str>
+def get_forwarded_env(environ):
+    names = set(FORWARDED_ENV) | set(environ.get('NIGHT_SHIFT_EXECUTOR_ENV', '').split())
+    return dict( (name, value) for name, value in environ.items() \
+        if (name in names or name.startswith(FORWARDED_ENV_PREFIX)) and name not in LOCAL_ENV )
+
+# void
+def set_keepalive(sock):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # Unacknowledged output is retransmitted instead of probed, the user timeout limits it the same way.
+    options = [
+        ('TCP_KEEPIDLE', KEEPALIVE_IDLE),
+        ('TCP_KEEPINTVL', KEEPALIVE_INTERVAL),
+        ('TCP_KEEPCNT', KEEPALIVE_COUNT),
+        ('TCP_USER_TIMEOUT', (KEEPALIVE_IDLE + KEEPALIVE_INTERVAL * KEEPALIVE_COUNT) * 1000)
+    ]
+    for name, value in options:
+        if hasattr(socket, name):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, name), value)
+
+# str
+def get_token(environ):
+    token = environ.get('NIGHT_SHIFT_EXECUTOR_TOKEN', '')
+    if not token:
+        raise ValueError('NIGHT_SHIFT_EXECUTOR_TOKEN is not set, it is the shared secret of the executor')
+    return token
+
+# bool
+def is_valid_token(message, token):
+    given = message.get('token')
+    return isinstance(given, type(u'')) and hmac.compare_digest(given.encode('utf-8'), token.encode('utf-8'))
+
+# void
+def log(message):
+    print('[{}] {}'.format(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), message))
+    sys.stdout.flush()
+
+class Connection(object):
+    # void
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = sock.makefile('rb')
+        self.lock = threading.Lock()
+
+    # Connection
+    @classmethod
+    def open(cls, address):
+        sock = socket.create_connection(parse_address(address))
+        set_keepalive(sock)
+        return cls(sock)
+
+    # bool
+    def send(self, message):
+        line = u'{}\n'.format(json.dumps(message)).encode('utf-8')
+        with self.lock:
+            try:
+                self.sock.sendall(line)
+                return True
+            except (IOError, OSError):
+                return False
+
+    # dict
+    def receive(self):
+        try:
+            line = self.reader.readline()
+            return json.loads(line.decode('utf-8')) if line else None
+        except (IOError, OSError, ValueError):
+            return None
+
+    # void
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except (IOError, OSError):
+            pass
+        self.reader.close()
+        self.sock.close()
+
+class Job(object):
+    # void
+    def __init__(self, spec, client):
+        self.spec = spec
+        self.client = client
+        self.lock = threading.Lock()
+        self.worker = None
+        self.is_cancelled = False
+        self.is_finished = False
+        self.submitted_at = time.time()
+
+    # bool
+    def assign(self, worker):
+        with self.lock:
+            if self.is_cancelled:
+                return False
+            self.worker = worker
+            return True
+
+    # void
+    def release(self):
+        with self.lock:
+            self.worker = None
+
+    # void
+    def cancel(self):
+        with self.lock:
+            if self.is_finished:
+                return
+            self.is_cancelled = True
+            worker = self.worker
+
+        if worker is not None:
+            worker.send({'type': 'cancel'})
+
+    # void
+    def finish(self, message):
+        with self.lock:
+            self.is_finished = True
+        self.client.send(message)
+
+class Coordinator(object):
+    # void
+    def __init__(self, address, token):
+        self.address = address
+        self.token = token
+        self.jobs = Queue()
+
+    # void
+    def serve(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(parse_address(self.address))
+        server.listen(128)
+        log('Coordinator is listening on {}'.format(self.address))
+
+        while True:
+            sock, _ = server.accept()
+            set_keepalive(sock)
+            thread = threading.Thread(target=self.handle, args=(Connection(sock), ))
+            thread.daemon = True
+            thread.start()
+
+    # void
+    def handle(self, conn):
+        try:
+            message = conn.receive() or {}
+            if not is_valid_token(message, self.token):
+                log('Rejected a connection with an invalid token')
+                conn.send({'type': 'error', 'error': 'invalid executor token'})
+            elif message.get('type') == 'submit':
+                self.handle_client(conn, message['job'])
+            elif message.get('type') == 'pull':
+                self.handle_worker(conn, message.get('worker'))
+        finally:
+            conn.close()
+
+    # void
+    def handle_client(self, conn, spec):
+        job = Job(spec, conn)
+        self.jobs.put(job)
+
+        # The tracking shell only closes its connection, when make is interrupted the recipe is stopped.
+        conn.receive()
+        job.cancel()
+
+    # Job
+    def take_job(self, conn):
+        while True:
+            job = self.jobs.get()
+            if job.assign(conn):
+                return job
+
+    # void
+    def handle_worker(self, conn, name):
+        job = self.take_job(conn)
+
+        # A worker lost before it started the recipe gives it back, it never ran.
+        message = conn.receive() if conn.send({'type': 'job', 'job': job.spec}) else None
+        if message is None or message.get('type') != 'started':
+            job.release()
+            self.jobs.put(job)
+            return
+
+        log('{} started {}'.format(name, job.spec['target']))
+        job.client.send({'type': 'started', 'worker': name, 'queue_wait': round(time.time() - job.submitted_at, 3)})
+        while True:
+            message = conn.receive()
+            if message is None:
+                log('{} was lost with {}'.format(name, job.spec['target']))
+                job.finish({'type': 'exit', 'exit_code': None, 'error': 'worker {} was lost'.format(name)})
+                return
+
+            if message.get('type') == 'output':
+                job.client.send(message)
+            elif message.get('type') == 'exit':
+                log('{} finished {} with exit code {}'.format(name, job.spec['target'], message['exit_code']))
+                job.finish(message)
+                return
+
+class Worker(object):
+    # void
+    def __init__(self, address, token, name, project_dir = None):
+        self.address = address
+        self.token = token
+        self.name = name
+        self.project_dir = project_dir
+
+    # void
+    def run(self):
+        interval = RECONNECT_INTERVAL
+        while True:
+            try:
+                conn = Connection.open(self.address)
+            except (IOError, OSError):
+                time.sleep(interval)
+                interval = min(interval * 2, MAX_RECONNECT_INTERVAL)
+                continue
+
+            # One connection per recipe, a lost connection never mixes up two of them.
+            interval = RECONNECT_INTERVAL
+            try:
+                if conn.send({'type': 'pull', 'token': self.token, 'worker': self.name}):
+                    message = conn.receive()
+                    if message is not None and message.get('type') == 'job':
+                        self.run_job(conn, message['job'])
+                    elif message is not None and message.get('type') == 'error':
+                        log('Coordinator refused {}: {}'.format(self.name, message['error']))
+                        time.sleep(MAX_RECONNECT_INTERVAL)
+            finally:
+                conn.close()
+
+    # list<str>
+    def read_metrics(self, path):
+        try:
+            with io.open(path, 'r', encoding='utf-8') as fd:
+                lines = fd.readlines()
+            os.remove(path)
+            return lines
+        except (IOError, OSError):
+            return []
+
+    # void
+    def watch(self, conn, process):
+        # A cancel or a lost coordinator stops the recipe, nobody waits for it anymore.
+        conn.receive()
+        if process.returncode is None:
+            try:
+                os.killpg(process.pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    # void
+    def run_job(self, conn, spec):
+        from tracking_shell import wait_process_usage
+
+        env = dict(os.environ)
+        env.update(spec['env'])
+        metrics_path = None
+        if 'NIGHT_SHIFT_METRICS_FILE' in spec['env']:
+            # Created by the first line, like the one of the tracking shell.
+            metrics_path = os.path.join(tempfile.gettempdir(), 'night-shift-metrics-{}.jsonl' \
+                .format(binascii.hexlify(os.urandom(8)).decode('ascii')))
+            env['NIGHT_SHIFT_METRICS_FILE'] = metrics_path
+
+        try:
+            process = subprocess.Popen(["/bin/bash", "-e", "-o", "pipefail", "-c", spec['command']], \
+                cwd=self.project_dir or spec['cwd'], env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, \
+                preexec_fn=os.setsid)
+        except OSError as e:
+            conn.send({'type': 'started'})
+            conn.send({'type': 'output', 'data': base64.b64encode(u'{}: {}\n'.format(self.name, e) \
+                .encode('utf-8')).decode('ascii')})
+            conn.send({'type': 'exit', 'exit_code': 127, 'usage': None, 'metrics': []})
+            return
+
+        conn.send({'type': 'started'})
+        watcher = threading.Thread(target=self.watch, args=(conn, process))
+        watcher.daemon = True
+        watcher.start()
+
+        try:
+            while True:
+                chunk = os.read(process.stdout.fileno(), OUTPUT_BUFFER_SIZE)
+                if not chunk:
+                    break
+                conn.send({'type': 'output', 'data': base64.b64encode(chunk).decode('ascii')})
+        finally:
+            process.stdout.close()
+
+        usage = wait_process_usage(process)
+        conn.send({
+            'type': 'exit',
+            'exit_code': process.returncode,
+            'usage': usage,
+            'metrics': self.read_metrics(metrics_path) if metrics_path else []
+        })
+
+class RemoteJob(object):
+    # void
+    def __init__(self, address, token, spec):
+        self.conn = Connection.open(address)
+        self.result = None
+        self.worker = None
+        self.queue_wait = None
+        if not self.conn.send({'type': 'submit', 'token': token, 'job': spec}):
+            self.conn.close()
+            raise IOError('Could not submit the job to {}'.format(address))
+
+    # RemoteJob
+    def __enter__(self):
+        return self
+
+    # void
+    def __exit__(self, *args):
+        self.conn.close()
+
+    # iter<bytes>
+    def iter_output(self):
+        while True:
+            message = self.conn.receive()
+            if message is None:
+                return
+
+            if message.get('type') == 'started':
+                self.worker, self.queue_wait = message['worker'], message['queue_wait']
+            elif message.get('type') == 'output':
+                yield base64.b64decode(message['data'])
+            elif message.get('type') in ('exit', 'error'):
+                self.result = message
+                return
+
+# void
+def serve_worker(address, token, name, slots, project_dir = None):
+    log('Worker {} is pulling from {} with {} slots'.format(name, address, slots))
+    for slot_nr in range(slots):
+        worker = Worker(address, token, '{}/{}'.format(name, slot_nr) if slots > 1 else name, project_dir)
+        thread = threading.Thread(target=worker.run)
+        thread.daemon = True
+        thread.start()
+
+    # Joins would block the signals of the main thread.
+    while True:
+        time.sleep(60)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='executor', \
+        description="Runs the recipes of the tracking shell on worker hosts")
+    subparsers = parser.add_subparsers(dest='mode')
+
+    coordinator_parser = subparsers.add_parser('coordinator', help='queue of the submitted recipes')
+    coordinator_parser.add_argument('-l', '--listen', default='127.0.0.1:{}'.format(DEFAULT_PORT), \
+        help='address of the coordinator, NIGHT_SHIFT_EXECUTOR of the tracking shell points to it')
+
+    worker_parser = subparsers.add_parser('worker', help='runs the recipes of a coordinator')
+    worker_parser.add_argument('-c', '--connect', default='localhost:{}'.format(DEFAULT_PORT), \
+        help='address of the coordinator')
+    worker_parser.add_argument('-s', '--slots', type=int, default=1, help='number of recipes run at the same time')
+    worker_parser.add_argument('-n', '--name', default=socket.gethostname(), help='name of the worker in the logs')
+    worker_parser.add_argument('-p', '--project-dir', \
+        help='project directory on this host, default: the directory of make')
+    args = parser.parse_args()
+
+    if args.mode not in ('coordinator', 'worker'):
+        parser.print_help()
+        sys.exit(1)
+
+    try:
+        token = get_token(os.environ)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.mode == 'coordinator':
+        Coordinator(args.listen, token).serve()
+    else:
+        serve_worker(args.connect, token, args.name, args.slots, args.project_dir)
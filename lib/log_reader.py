@@ -0,0 +1,89 @@
+import os
+
+BLOCK_SIZE = 1024 * 1024
+
+# Longest line prefix kept while lines are assembled backwards.
+MAX_LINE_PREFIX = 64 * 1024
+
+# int
+def get_size(fd):
+    fd.seek(0, os.SEEK_END)
+    return fd.tell()
+
+# iter<bytes>
+def iter_blocks(fd, start = 0, end = None, block_size = BLOCK_SIZE):
+    end = get_size(fd) if end is None else end
+    fd.seek(start)
+    while start < end:
+        block = fd.read(min(block_size, end - start))
+        if not block:
+            break
+        start += len(block)
+        yield block
+
+# iter<tuple<int,bytes>>
+def iter_reversed_blocks(fd, start = 0, end = None, block_size = BLOCK_SIZE):
+    end = get_size(fd) if end is None else end
+    while end > start:
+        block_start = max(start, end - block_size)
+        fd.seek(block_start)
+        yield block_start, fd.read(end - block_start)
+        end = block_start
+
+# iter<bytes>
+def iter_reversed_lines(fd, start = 0, end = None, block_size = BLOCK_SIZE):
+    carry = None
+    for _, block in iter_reversed_blocks(fd, start, end, block_size):
+        lines = block.split(b'\n')
+        if carry is not None:
+            lines[-1] += carry
+
+        for line in reversed(lines[1:]):
+            yield line
+
+        # The first piece may continue in the previous block, but only its
+        # beginning matters for line prefix matching.
+        carry = lines[0][:MAX_LINE_PREFIX]
+
+    if carry is not None:
+        yield carry
+
+# int
+def count_newlines(fd, start = 0, end = None, block_size = BLOCK_SIZE):
+    return sum(block.count(b'\n') for block in iter_blocks(fd, start, end, block_size))
+
+# int
+def find_last_newline(fd, start = 0, end = None, block_size = BLOCK_SIZE):
+    for block_start, block in iter_reversed_blocks(fd, start, end, block_size):
+        position = block.rfind(b'\n')
+        if position != -1:
+            return block_start + position
+    return -1
+
+# re.Match
+def search_last_line(fd, rexp, start = 0, end = None, block_size = BLOCK_SIZE):
+    for line in iter_reversed_lines(fd, start, end, block_size):
+        match = rexp.search(line)
+        if match:
+            return match
+
+# int
+def find_tail_offset(fd, lines, start = 0, end = None, block_size = BLOCK_SIZE):
+    end = get_size(fd) if end is None else end
+    if lines <= 0:
+        return end
+
+    # A newline closing the last line does not start a new one.
+    last_position = end - 1
+    for block_start, block in iter_reversed_blocks(fd, start, end, block_size):
+        position = min(len(block), last_position - block_start)
+        while True:
+            position = block.rfind(b'\n', 0, position)
+            if position == -1:
+                break
+
+            lines -= 1
+            if lines == 0:
+                return block_start + position + 1
+
+    return start
@@ -0,0 +1,274 @@
+#!/usr/bin/env pypy
+
+from __future__ import print_function
+import os
+import io
+import zlib
+import json
+import bisect
+import argparse
+import collections
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Uncompressed size of one independently compressed frame.
+FRAME_SIZE = 1024 * 1024
+
+EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+
+# Logs which are appended during the whole day.
+ACTIVE_LOGS = ['timing_env.log', 'trackingshell.log']
+
+LogStat = collections.namedtuple('LogStat', ['st_size', 'st_mtime', 'st_ino'])
+
+# bytes
+def compress_frame(method, data):
+    if method == 'zstd':
+        return zstandard.ZstdCompressor().compress(data)
+
+    # wbits=31 writes a complete gzip member, so the file stays readable by `zcat`.
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+# bytes
+def decompress_frame(method, data):
+    if method == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+
+    return zlib.decompress(data, 31)
+
+# str
+def get_index_path(compressed_path):
+    return '{}.idx'.format(compressed_path)
+
+# dict
+def load_index(compressed_path):
+    try:
+        with io.open(get_index_path(compressed_path), 'rb') as fd:
+            return json.loads(fd.read().decode('utf-8'))
+    except IOError:
+        return None
+
+# void
+def save_index(compressed_path, index):
+    index_path = get_index_path(compressed_path)
+    tmp_path = '{}.{}.tmp'.format(index_path, os.getpid())
+    with io.open(tmp_path, 'wb') as fd:
+        fd.write(json.dumps(index).encode('utf-8'))
+    os.rename(tmp_path, index_path)
+
+# tuple<str,dict>
+def find_compressed(path):
+    for method, extension in EXTENSIONS.items():
+        compressed_path = path + extension
+        if os.path.exists(compressed_path):
+            index = load_index(compressed_path)
+            if index is not None:
+                return compressed_path, index
+    return None, None
+
+# str
+def get_log_path(path):
+    for extension in EXTENSIONS.values():
+        if path.endswith(extension):
+            return path[:-len(extension)]
+    return path
+
+# bool
+def is_log_file(file_name):
+    return get_log_path(file_name).endswith('.log')
+
+# bool
+def exists(path):
+    return os.path.exists(path) or find_compressed(path)[0] is not None
+
+# bool
+def is_readable_log_file(file_name, file_names):
+    if not is_log_file(file_name):
+        return False
+
+    # A log compressed by something else (e.g. logrotate) has no index, it can not be read.
+    return file_name == get_log_path(file_name) or get_index_path(file_name) in file_names
+
+# list<str>
+def list_logs(directory):
+    file_names = set(os.listdir(directory))
+    return sorted(set( os.path.join(directory, get_log_path(f)) \
+        for f in file_names \
+        if is_readable_log_file(f, file_names) ))
+
+# LogStat
+def stat(path):
+    compressed_path, index = find_compressed(path)
+    try:
+        plain_stat = os.stat(path)
+    except OSError:
+        if compressed_path is None: raise
+        plain_stat = None
+
+    if compressed_path is None:
+        return LogStat(plain_stat.st_size, plain_stat.st_mtime, plain_stat.st_ino)
+
+    compressed_stat = os.stat(compressed_path)
+    return LogStat(
+        index['size'] + (plain_stat.st_size if plain_stat else 0),
+        max(compressed_stat.st_mtime, plain_stat.st_mtime if plain_stat else 0),
+        compressed_stat.st_ino
+    )
+
+# int
+def get_size(path):
+    return stat(path).st_size
+
+class LogFile(object):
+    # void
+    def __init__(self, path):
+        self.path = path
+        self.position = 0
+        self.frame_nr, self.frame = None, b''
+        self.compressed_path, self.index = find_compressed(path)
+        self.compressed_fd = io.open(self.compressed_path, 'rb') if self.compressed_path else None
+        self.compressed_size = self.index['size'] if self.index else 0
+        self.frame_offsets = [ frame[0] for frame in self.index['frames'] ] if self.index else []
+
+        try:
+            self.plain_fd = io.open(path, 'rb')
+        except IOError:
+            if self.compressed_fd is None: raise
+            self.plain_fd = None
+
+    # LogFile
+    def __enter__(self):
+        return self
+
+    # void
+    def __exit__(self, *args):
+        self.close()
+
+    # void
+    def close(self):
+        for fd in (self.compressed_fd, self.plain_fd):
+            if fd is not None:
+                fd.close()
+
+    # int
+    def get_size(self):
+        plain_size = os.fstat(self.plain_fd.fileno()).st_size if self.plain_fd else 0
+        return self.compressed_size + plain_size
+
+    # int
+    def tell(self):
+        return self.position
+
+    # int
+    def seek(self, offset, whence = os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.get_size()
+
+        self.position = max(0, offset)
+        return self.position
+
+    # bytes
+    def read_frame(self, frame_nr):
+        if frame_nr != self.frame_nr:
+            frames = self.index['frames']
+            start = frames[frame_nr][1]
+            end = frames[frame_nr+1][1] if frame_nr+1 < len(frames) else self.index['compressed_size']
+            self.compressed_fd.seek(start)
+            self.frame_nr = frame_nr
+            self.frame = decompress_frame(self.index['method'], self.compressed_fd.read(end - start))
+        return self.frame
+
+    # bytes
+    def read_compressed(self, size):
+        frame_nr = bisect.bisect_right(self.frame_offsets, self.position) - 1
+        frame = self.read_frame(frame_nr)
+        start = self.position - self.frame_offsets[frame_nr]
+        return frame[start:start+size] if size >= 0 else frame[start:]
+
+    # bytes
+    def read_plain(self, size):
+        if self.plain_fd is None:
+            return b''
+
+        self.plain_fd.seek(self.position - self.compressed_size)
+        return self.plain_fd.read(size) if size >= 0 else self.plain_fd.read()
+
+    # bytes
+    def read(self, size = -1):
+        chunks = []
+        while size != 0:
+            if self.position < self.compressed_size:
+                chunk = self.read_compressed(size)
+            else:
+                chunk = self.read_plain(size)
+
+            if not chunk:
+                break
+
+            chunks.append(chunk)
+            self.position += len(chunk)
+            if size > 0:
+                size -= len(chunk)
+
+        return b''.join(chunks)
+
+# LogFile
+def open_log(path):
+    return LogFile(path)
+
+# str
+def compress(path, method = 'gzip', frame_size = FRAME_SIZE):
+    if method == 'zstd' and zstandard is None:
+        raise ValueError('Compression method `zstd` requires the `zstandard` package')
+
+    compressed_path = path + EXTENSIONS[method]
+    index = load_index(compressed_path) if os.path.exists(compressed_path) else None
+    if index is None and os.path.exists(compressed_path):
+        raise ValueError('Missing frame index of `{}`'.format(compressed_path))
+
+    if index is None:
+        index = {'method': method, 'frames': [], 'size': 0, 'compressed_size': 0}
+
+    # Frames are appended after the indexed ones, so logs of later attempts
+    # end up in the same seekable file.
+    fd = os.open(compressed_path, os.O_RDWR | os.O_CREAT, 0o644)
+    with io.open(fd, 'r+b') as dst, io.open(path, 'rb') as src:
+        dst.truncate(index['compressed_size'])
+        dst.seek(index['compressed_size'])
+        while True:
+            chunk = src.read(frame_size)
+            if not chunk:
+                break
+
+            frame = compress_frame(index['method'], chunk)
+            index['frames'].append([index['size'], index['compressed_size']])
+            dst.write(frame)
+            index['size'] += len(chunk)
+            index['compressed_size'] += len(frame)
+
+    save_index(compressed_path, index)
+    os.remove(path)
+    return compressed_path
+
+# list<str>
+def compress_directory(directory, method = 'gzip'):
+    return [ compress(path, method) \
+        for path in list_logs(directory) \
+        if os.path.basename(path) not in ACTIVE_LOGS and os.path.exists(path) ]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='log_storage', \
+        description="Compresses the logs of finished dates into seekable frames")
+    parser.add_argument('directories', nargs='+', help='log directories, e.g. logs/2015-01-01')
+    parser.add_argument('-m', '--method', choices=sorted(EXTENSIONS), default='gzip', help='compression method')
+    args = parser.parse_args()
+
+    for directory in args.directories:
+        for compressed_path in compress_directory(directory, args.method):
+            print('Compressed {}'.format(compressed_path))
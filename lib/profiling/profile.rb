@@ -0,0 +1,31 @@
+# Loaded by every Ruby process of a profiled target, the tracking shell adds it
+# to RUBYOPT (see `profile_plugin` in tracking_shell.py).
+
+if ENV['NIGHT_SHIFT_PROFILE_PREFIX'] and ENV['NIGHT_SHIFT_PROFILE_DIR']
+  module NightShiftProfiler
+    # Samples the wall clock stack of the main thread. The sampler needs the
+    # interpreter lock, so CPU bound code is sampled at every thread switch.
+    def self.start(interval)
+      samples = Hash.new(0)
+      main = Thread.main
+      sampler = Thread.new do
+        loop do
+          sleep interval
+          locations = main.backtrace_locations
+          next if locations.nil? or locations.empty?
+          samples[locations.reverse.map { |l| "#{l.label} (#{l.path})".tr(';', ':') }.join(';')] += 1
+        end
+      end
+
+      at_exit do
+        sampler.kill
+        unless samples.empty?
+          path = File.join(ENV['NIGHT_SHIFT_PROFILE_DIR'], "#{ENV['NIGHT_SHIFT_PROFILE_PREFIX']}.#{Process.pid}.folded")
+          File.open(path, 'w') { |f| samples.sort.each { |stack, count| f.puts("#{stack} #{count}") } }
+        end
+      end
+    end
+  end
+
+  NightShiftProfiler.start((ENV['NIGHT_SHIFT_PROFILE_INTERVAL'] || '0.01').to_f)
+end
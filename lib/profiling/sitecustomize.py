@@ -0,0 +1,139 @@
+# Loaded by every Python process of a profiled target, the tracking shell puts
+# this directory on the PYTHONPATH (see `profile_plugin` in tracking_shell.py).
+
+import os
+import sys
+
+# void
+def load_shadowed_sitecustomize():
+    # The sitecustomize of the interpreter is hidden by this one, so it is loaded here.
+    this_dir = os.path.dirname(os.path.abspath(__file__))
+    this_module = sys.modules.pop('sitecustomize', None)
+    sys_path = sys.path[:]
+    sys.path[:] = [ p for p in sys.path if os.path.abspath(p or '.') != this_dir ]
+    try:
+        import sitecustomize
+    except ImportError:
+        pass
+    finally:
+        sys.path[:] = sys_path
+        if this_module is not None:
+            sys.modules['sitecustomize'] = this_module
+
+# str
+def get_profile_path(extension):
+    return os.path.join(os.environ['NIGHT_SHIFT_PROFILE_DIR'], '{}.{}.{}'.format( \
+        os.environ['NIGHT_SHIFT_PROFILE_PREFIX'], os.getpid(), extension))
+
+class SamplingProfiler(object):
+    # void
+    def __init__(self, interval):
+        self.interval = interval
+        self.samples = {}
+
+    # str
+    def get_frame_name(self, frame):
+        code = frame.f_code
+        return '{} ({}:{})'.format(code.co_name, code.co_filename, code.co_firstlineno).replace(';', ':')
+
+    # void
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            stack.append(self.get_frame_name(frame))
+            frame = frame.f_back
+        key = ';'.join(reversed(stack))
+        self.samples[key] = self.samples.get(key, 0) + 1
+
+    # void
+    def start(self):
+        import signal
+
+        # SIGPROF ticks on the CPU time of the process, the interrupted system calls are restarted.
+        signal.signal(signal.SIGPROF, self.sample)
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    # void
+    def restart(self):
+        # A forked child has the samples of its parent, but not its timer.
+        self.samples = {}
+        self.start()
+
+    # void
+    def stop(self):
+        import signal
+
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        if not self.samples:
+            return
+
+        # The folded format of flamegraph.pl and speedscope: `root;...;leaf count`.
+        with open(get_profile_path('folded'), 'w') as fd:
+            for stack, count in sorted(self.samples.items()):
+                fd.write('{} {}\n'.format(stack, count))
+
+class DeterministicProfiler(object):
+    # void
+    def __init__(self):
+        import cProfile
+        self.profile = cProfile.Profile()
+
+    # void
+    def start(self):
+        self.profile.enable()
+
+    # void
+    def restart(self):
+        import cProfile
+        self.profile.disable()
+        self.profile = cProfile.Profile()
+        self.start()
+
+    # void
+    def stop(self):
+        import pstats
+
+        self.profile.disable()
+        self.profile.dump_stats(get_profile_path('prof'))
+        with open(get_profile_path('txt'), 'w') as fd:
+            pstats.Stats(self.profile, stream=fd).sort_stats('cumulative').print_stats(50)
+
+# void
+def start_profiler():
+    import atexit
+
+    if os.environ.get('NIGHT_SHIFT_PROFILE_MODE') == 'cprofile':
+        profiler = DeterministicProfiler()
+    else:
+        profiler = SamplingProfiler(float(os.environ.get('NIGHT_SHIFT_PROFILE_INTERVAL') or 0.01))
+
+    profiler.start()
+    atexit.register(profiler.stop)
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=profiler.restart)
+
+    # The timer survives an exec, its SIGPROF would kill the new program. The exec functions
+    # all end in these two, and the profile is written before them as atexit never runs.
+    for name in ('execv', 'execve'):
+        setattr(os, name, wrap_exec(getattr(os, name), profiler))
+
+# function
+def wrap_exec(exec_fn, profiler):
+    # void
+    def exec_without_profiler(*args):
+        profiler.stop()
+        try:
+            exec_fn(*args)
+        except OSError:
+            # Only a failed exec returns, e.g. `os.execvp` tries every directory of the PATH.
+            profiler.start()
+            raise
+    return exec_without_profiler
+
+load_shadowed_sitecustomize()
+if os.environ.get('NIGHT_SHIFT_PROFILE_PREFIX') and os.environ.get('NIGHT_SHIFT_PROFILE_DIR'):
+    try:
+        start_profiler()
+    except (ImportError, ValueError, OSError) as e:
+        sys.stderr.write('[!] night-shift profiler is not started: {}\n'.format(e))
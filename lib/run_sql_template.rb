@@ -5,6 +5,10 @@ require 'json'
 require 'optparse'
 require 'tempfile'
 require 'shellwords'
+require 'securerandom'
+require 'socket'
+require 'digest'
+require 'zlib'
 
 def extract_exports(config_file)
   contents = File.read(config_file)
@@ -18,6 +22,7 @@ def get_final_query(expanded_query, mode, options)
     return "#{expanded_query.chomp(';')};" if options[:dialect] == :mysql
     return "#{expanded_query}" if options[:dialect] == :mssql
     return "#{psql_prefix}#{expanded_query.chomp(';')};" if [:postgres, :redshift].include?(options[:dialect])
+    return "#{expanded_query.chomp(';')};" if options[:dialect] == :sqlite
   else
     if options[:dialect] == :mssql
       # Note: have to add few extra parameters into `sqlcmd`.
@@ -32,6 +37,349 @@ def get_final_query(expanded_query, mode, options)
       return "#{expanded_query.chomp(';')};"
     elsif options[:dialect] == :postgres
       return "#{psql_prefix} COPY (#{expanded_query.chomp(';')}) TO STDOUT WITH CSV HEADER;"
+    elsif options[:dialect] == :sqlite
+      return ".headers on\n.mode csv\n#{expanded_query.chomp(';')};"
+    end
+  end
+end
+
+def get_cli_command(options)
+  if options[:dialect] == :mysql
+    env = extract_exports(options[:config])
+    # `--unbuffered` flushes every result, a session waits for them.
+    ". #{options[:config].shellescape} && mysql --default-character-set=latin1 --batch --quick --unbuffered " +
+      "-P #{env['MYSQL_PORT']} -u #{env['MYSQL_USER']} #{env['MYSQL_DATABASE']}"
+  elsif [:postgres, :redshift].include?(options[:dialect])
+    ". #{options[:config].shellescape} && psql -X -t"
+  elsif options[:dialect] == :sqlite
+    ". #{options[:config].shellescape} && sqlite3 -bail -batch \"$SQLITE_DATABASE\""
+  end
+end
+
+# Writes the final result to stdout in large blocks and counts its rows.
+class ResultOutput
+  BUFFER_SIZE = 1024 * 1024
+
+  attr_reader :rows, :bytes
+
+  def initialize(has_header)
+    @has_header = has_header
+    @header = nil
+    @in_quotes = false
+    @rows = 0
+    @bytes = 0
+    @buffer = String.new
+    @started_at = Time.now
+  end
+
+  def <<(line)
+    line = line.b
+    line << "\n" unless line.end_with?("\n")
+    @bytes += line.bytesize
+
+    if @has_header and @header.nil?
+      @header = line
+    else
+      # A quoted CSV field can contain new lines, the record ends with the closing quote.
+      @in_quotes = !@in_quotes if line.count('"').odd?
+      @rows += 1 unless @in_quotes
+    end
+    write(line, !@in_quotes)
+    self
+  end
+
+  def write(line, is_record_end)
+    @buffer << line
+    flush_buffer if @buffer.bytesize >= BUFFER_SIZE
+  end
+
+  def flush_buffer
+    STDOUT.write(@buffer)
+    @buffer = String.new
+  end
+
+  def close(is_complete = true)
+    flush_buffer
+    STDOUT.flush
+  end
+
+  def metrics
+    seconds = [Time.now - @started_at, 0.001].max
+    {:rows => @rows, :bytes => @bytes, :seconds => seconds.round(3),
+      :rows_per_second => (@rows / seconds).round(1), :bytes_per_second => (@bytes / seconds).round}
+  end
+end
+
+# Keeps the size and the checksum of a file while it is written.
+class DigestWriter
+  attr_reader :size
+
+  def initialize(path)
+    @file = File.open(path, 'wb')
+    @digest = Digest::SHA256.new
+    @size = 0
+  end
+
+  def write(data)
+    @digest.update(data)
+    @size += data.bytesize
+    @file.write(data)
+  end
+
+  def flush
+    @file.flush
+  end
+
+  def close
+    @file.close
+  end
+
+  def hexdigest
+    @digest.hexdigest
+  end
+end
+
+# Splits the final result into (compressed) chunk files of about the same size.
+# Every chunk starts with the CSV header, the manifest is written when the export is complete.
+class ChunkedExport < ResultOutput
+  def initialize(path, has_header, chunk_size, compression)
+    super(has_header)
+    @path = path
+    @chunk_size = chunk_size
+    @compression = compression
+    @chunks = []
+    @writer = nil
+  end
+
+  def get_chunk_path(chunk_nr)
+    suffix = @compression == 'gzip' ? '.gz' : ''
+    return "#{@path}#{suffix}" if @chunk_size.zero?
+
+    extension = File.extname(@path)
+    "#{@path.chomp(extension)}.#{'%04d' % chunk_nr}#{extension}#{suffix}"
+  end
+
+  def get_manifest_path
+    "#{@path}.manifest.json"
+  end
+
+  def open_chunk
+    path = get_chunk_path(@chunks.size)
+    @writer = DigestWriter.new(path)
+    @file = @compression == 'gzip' ? Zlib::GzipWriter.new(@writer) : @writer
+    @chunks << {:path => File.basename(path), :rows => 0, :bytes => 0}
+    @chunk_rows = 0
+    @chunk_bytes = 0
+    write(@header, true) if @header and @chunks.size > 1
+  end
+
+  def close_chunk
+    flush_buffer
+    @compression == 'gzip' ? @file.finish : @file.flush
+    @writer.close
+    @chunks.last.update(:rows => @chunk_rows, :bytes => @chunk_bytes, :size => @writer.size,
+      :sha256 => @writer.hexdigest)
+    @writer = nil
+  end
+
+  def write(line, is_record_end)
+    open_chunk if @writer.nil?
+    @chunk_bytes += line.bytesize
+    # The header is the same string in every chunk, it is not a row.
+    @chunk_rows += 1 if is_record_end and not line.equal?(@header)
+    super
+    close_chunk if is_record_end and @chunk_size > 0 and @chunk_bytes >= @chunk_size
+  end
+
+  def flush_buffer
+    @file.write(@buffer) unless @buffer.empty?
+    @buffer = String.new
+  end
+
+  def close(is_complete = true)
+    open_chunk if @chunks.empty?
+    close_chunk unless @writer.nil?
+    # An incomplete export has no manifest.
+    return unless is_complete
+
+    manifest = {:rows => @rows, :bytes => @bytes, :header => !@header.nil?, :compression => @compression,
+      :chunks => @chunks}
+    tmp_path = "#{get_manifest_path}.#{Process.pid}.tmp"
+    File.write(tmp_path, JSON.pretty_generate(manifest))
+    File.rename(tmp_path, get_manifest_path)
+  end
+
+  def metrics
+    super.merge(:chunks => @chunks.size, :compressed_bytes => @chunks.map { |c| c[:size] }.reduce(0, :+))
+  end
+end
+
+# The tracking shell adds these to the END record of the target in timing_env.log.
+def report_metrics(metrics)
+  path = ENV['NIGHT_SHIFT_METRICS_FILE']
+  return if path.nil? or path.empty?
+  File.open(path, 'a') { |f| f.puts(JSON.generate(metrics)) }
+end
+
+def get_result_output(options)
+  # bcp writes the CSV without a header.
+  has_header = (options[:csv] and options[:dialect] != :mssql)
+  return ResultOutput.new(has_header) if options[:export].nil?
+
+  ChunkedExport.new(options[:export], has_header, options[:chunk_size], options[:compression])
+end
+
+# One database connection for many queries: every query is followed by a
+# sentinel, its output ends where the sentinel is echoed back.
+class SqlSession
+  RESET_COMMANDS = {
+    :postgres => "\\set QUIET on\n\\pset format aligned\n\\pset fieldsep '|'\n\\pset tuples_only on\n\\pset footer on\n",
+    :redshift => "\\set QUIET on\n\\pset format aligned\n\\pset fieldsep '|'\n\\pset tuples_only on\n\\pset footer on\n",
+    :sqlite => ".mode list\n.headers off\n",
+    :mysql => ""
+  }
+  # Clears what a query leaves behind on the connection: an open transaction, settings,
+  # temporary tables. The other dialects can not do it, their sessions are not shared.
+  CONNECTION_RESETS = {
+    :postgres => "ROLLBACK;\nDISCARD ALL;\n"
+  }
+  SENTINEL_HEADER = "night_shift_sentinel"
+
+  def initialize(options)
+    @options = options
+    @cli = nil
+  end
+
+  def self.supports?(dialect)
+    RESET_COMMANDS.has_key?(dialect)
+  end
+
+  # True if the connection is like a new one again.
+  def reset_connection
+    return false if @cli.nil? or not CONNECTION_RESETS.has_key?(@options[:dialect])
+    run(CONNECTION_RESETS[@options[:dialect]]) { |line| }.nil?
+  end
+
+  def sentinel_command(sentinel)
+    case @options[:dialect]
+    when :mysql then "\nSELECT '#{sentinel}' AS #{SENTINEL_HEADER};\n"
+    when :sqlite then "\n.print #{sentinel}\n"
+    else "\n\\echo #{sentinel}\n"
+    end
+  end
+
+  # Yields the output lines of the query, the status is nil on success.
+  def run(query)
+    @cli ||= IO.popen(get_cli_command(@options), "r+")
+    sentinel = "night-shift-#{SecureRandom.hex(8)}"
+    @cli.write("#{RESET_COMMANDS[@options[:dialect]]}#{query}#{sentinel_command(sentinel)}")
+    @cli.flush
+
+    previous = nil
+    while (line = @cli.gets)
+      break if line.chomp == sentinel
+      yield previous unless previous.nil?
+      previous = line
+    end
+    # The column name of the mysql sentinel is the last line before it.
+    yield previous unless previous.nil? or (line and @options[:dialect] == :mysql and previous.chomp == SENTINEL_HEADER)
+    return nil if line
+
+    # The cli quits on the first error (ON_ERROR_STOP, -bail, mysql --batch).
+    close
+    $?
+  rescue Errno::EPIPE
+    close
+    $?
+  end
+
+  def close
+    return if @cli.nil?
+    @cli.close
+    @cli = nil
+  end
+end
+
+def run_query_in_session(expanded_query, query, mode, options, output)
+  session = (options[:sessions] ||= {})[[options[:dialect], options[:config]]] ||= SqlSession.new(options)
+  result = []
+  status = session.run(query) do |line|
+    mode == :intermediate ? result << line : output << line
+  end
+
+  if status
+    STDERR.puts "Failed Query:\n#{expanded_query}\n\n"
+    raise "cli exited with #{status}"
+  end
+
+  mode == :intermediate ? result : nil
+end
+
+# The broker keeps a pool of sessions, so the connections are reused between targets.
+def run_query_with_broker(expanded_query, query, mode, options, output)
+  socket = UNIXSocket.new(options[:broker])
+  socket.puts(JSON.generate({:dialect => options[:dialect], :config => options[:config], :query => query}))
+
+  result = []
+  status = nil
+  while (line = socket.gets)
+    if line.start_with?("D")
+      mode == :intermediate ? result << line[1..-1] : output << line[1..-1]
+    elsif line.start_with?("S")
+      status = JSON.parse(line[1..-1])
+      break
+    end
+  end
+  socket.close
+
+  if status.nil? or status['error']
+    STDERR.puts "Failed Query:\n#{expanded_query}\n\n"
+    raise "broker failed with #{status ? status['error'] : 'a closed connection'}"
+  end
+
+  mode == :intermediate ? result : nil
+end
+
+def serve_broker(socket_path, pool_size)
+  File.delete(socket_path) if File.exist?(socket_path)
+  server = UNIXServer.new(socket_path)
+  pools = Hash.new { |h, k| h[k] = {:idle => [], :count => 0} }
+  lock = Mutex.new
+  released = ConditionVariable.new
+  STDERR.puts "[+] Serving SQL sessions on #{socket_path}"
+
+  loop do
+    Thread.new(server.accept) do |client|
+      begin
+        request = JSON.parse(client.gets)
+        options = {:dialect => request['dialect'].to_sym, :config => request['config']}
+        raise "unsupported dialect #{options[:dialect]}" unless SqlSession.supports?(options[:dialect])
+        pool = pools[[options[:dialect], options[:config]]]
+
+        session = lock.synchronize do
+          released.wait(lock) while pool[:idle].empty? and pool[:count] >= pool_size
+          pool[:count] += 1 if pool[:idle].empty?
+          pool[:idle].pop || SqlSession.new(options)
+        end
+
+        status = nil
+        begin
+          status = session.run(request['query']) { |line| client.write("D#{line}") }
+        ensure
+          # The next target must not see the state of this one, a session which can not be reset is closed.
+          is_reset = (status.nil? and session.reset_connection) rescue false
+          session.close unless is_reset
+          lock.synchronize do
+            is_reset ? pool[:idle].push(session) : pool[:count] -= 1
+            released.signal
+          end
+        end
+        client.puts("S#{JSON.generate({:error => status ? "cli exited with #{status}" : nil})}")
+      rescue => e
+        client.puts("S#{JSON.generate({:error => e.message})}") rescue nil
+      ensure
+        client.close
+      end
     end
   end
 end
@@ -44,10 +392,34 @@ def run_query_with_cli(expanded_query, mode, options)
   end
 
   query = get_final_query(expanded_query, mode, options)
+  output = get_result_output(options) if mode == :final
+  is_complete = false
+  begin
+    if options[:broker] and File.socket?(options[:broker]) and SqlSession.supports?(options[:dialect])
+      result = run_query_with_broker(expanded_query, query, mode, options, output)
+    elsif options[:session] and SqlSession.supports?(options[:dialect])
+      result = run_query_in_session(expanded_query, query, mode, options, output)
+    else
+      result = run_query_with_new_cli(expanded_query, query, mode, options, output)
+    end
+    is_complete = true
+  ensure
+    # The rows read before a failure are written too.
+    output.close(is_complete) if output
+  end
+
+  if output
+    metrics = output.metrics
+    STDERR.puts "[+] Wrote #{metrics[:rows]} rows (#{metrics[:bytes]} bytes) in #{metrics[:seconds]}s"
+    report_metrics(metrics)
+  end
+  result
+end
+
+def run_query_with_new_cli(expanded_query, query, mode, options, output)
+
   if options[:dialect] == :mysql
-    env = extract_exports(options[:config])
-    cli = IO.popen(". #{options[:config].shellescape} && mysql --default-character-set=latin1 --batch --quick " +
-      "-P #{env['MYSQL_PORT']} -u #{env['MYSQL_USER']} #{env['MYSQL_DATABASE']}", "r+")
+    cli = IO.popen(get_cli_command(options), "r+")
     cli.write(query)
     cli.close_write
 
@@ -68,8 +440,8 @@ def run_query_with_cli(expanded_query, mode, options)
       cli.write(query)
     end
     cli.close_write
-  elsif [:postgres, :redshift].include?(options[:dialect])
-    cli = IO.popen(". #{options[:config].shellescape} && psql -X -t", "r+")
+  elsif [:postgres, :redshift, :sqlite].include?(options[:dialect])
+    cli = IO.popen(get_cli_command(options), "r+")
     cli.write(query)
     cli.close_write
   end
@@ -83,7 +455,7 @@ def run_query_with_cli(expanded_query, mode, options)
     end
   else
     cli.each do |line|
-      puts line
+      output << line
     end
     result = nil
   end
@@ -146,23 +518,41 @@ def process_templates(options)
 end
 
 if $0 == __FILE__
-  options = {:config => nil, :dialect => nil, :csv => false, :dryrunfirst => false, :dryrunlast => false, :context => {}}
+  options = {:config => nil, :dialect => nil, :csv => false, :dryrunfirst => false, :dryrunlast => false, :context => {},
+    :session => ENV['NIGHT_SHIFT_SQL_SESSION'] == '1', :broker => ENV['NIGHT_SHIFT_SQL_BROKER'], :serve => nil, :pool_size => 4,
+    :export => nil, :chunk_size => 0, :compression => nil}
   OptionParser.new do |opt|
-    opt.on('-d', '--dialect DIALECT', [:postgres, :mysql, :redshift, :mssql], 'Database dialect (postgres, mysql, redshift, mssql)') { |o| options[:dialect] = o }
+    opt.on('-d', '--dialect DIALECT', [:postgres, :mysql, :redshift, :mssql, :sqlite], 'Database dialect (postgres, mysql, redshift, mssql, sqlite)') { |o| options[:dialect] = o }
     opt.on('-c', '--config CONFIG_FILE', 'Configuration file.') { |o| options[:config] = File.absolute_path(o) }
     opt.on('--csv', "Convert the query's result into CSV") { |o| options[:csv] = true }
     opt.on('-nf', 'Do not execute the first SQL, only print it. Terminate after the first one.') { |o| options[:dryrunfirst] = true }
     opt.on('-nl', 'Do not execute the last SQL, only print it.') { |o| options[:dryrunlast] = true }
-    ARGV.select { |attr| attr =~ /^--(\w+)$/ and not ['--config','--dialect','--csv'].include?(attr) } \
+    opt.on('--session', 'Run every template over one database connection.') { |o| options[:session] = true }
+    opt.on('--broker SOCKET', 'Run the queries on the sessions of a broker.') { |o| options[:broker] = o }
+    opt.on('--serve SOCKET', 'Start a broker which keeps the database connections open.') { |o| options[:serve] = o }
+    opt.on('--pool-size SIZE', Integer, 'Number of sessions of a broker per database.') { |o| options[:pool_size] = o }
+    opt.on('--export PATH', 'Write the final result into PATH (and a manifest) instead of stdout.') { |o| options[:export] = o }
+    opt.on('--chunk-size MB', Integer, 'Split the export into chunks of MB megabytes.') { |o| options[:chunk_size] = o * 1024 * 1024 }
+    opt.on('--compress METHOD', ['gzip'], 'Compress the exported chunks (gzip).') { |o| options[:compression] = o }
+    ARGV.select { |attr| attr =~ /^--(\w+)$/ and not ['--config','--dialect','--csv','--session','--broker','--serve','--export','--compress'].include?(attr) } \
         .each { |attr| opt.on("#{attr} VALUE") { |o| options[:context][/^--(\w+)$/.match(attr)[1]] = o } }
   end.parse!
   options[:templates] = ARGV.map { |f| File.absolute_path(f) }
 
+  if options[:serve]
+    serve_broker(options[:serve], options[:pool_size])
+    exit
+  end
+
   raise "Need at least one template." if options[:templates].empty?
   raise "Configuration file is required." if options[:context].nil?
   raise "Dialect attribute is required." if options[:dialect].nil?
   raise "Not existing configuration file." if not File.exist?(options[:config])
   raise "Template is not exists." if not options[:templates].map { |f| File.exist?(f) } .all?
 
-  process_templates(options)
+  begin
+    process_templates(options)
+  ensure
+    (options[:sessions] || {}).values.each(&:close)
+  end
 end
@@ -0,0 +1,279 @@
+#!/usr/bin/env pypy
+
+# Python version of `run_workflow.sh`, it gets triggered by cron as well.
+
+# The first attempt runs every target, the next ones only retry the failed
+# targets (and their dependents) with a per-target exponential backoff. Every
+# cron trigger runs at most one attempt, the one whose targets are due.
+# The attempts stay in `logs/<date>/attempt-*.log`, and the output is the same:
+# nothing, unless the final attempt failed or everything is finished.
+
+from __future__ import print_function
+import os
+import io
+import sys
+import json
+import time
+import fcntl
+import argparse
+import datetime
+import subprocess
+
+LIB_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, LIB_DIR)
+from timing_env import TimingEnvLogReader
+from critical_path import GRAPH_FILE_NAME
+from schedule import load_graph, get_dependents
+
+STATE_FILE_NAME = 'workflow_state.json'
+LOCK_PATH = 'logs/run_workflow.lock'
+
+# dict<str,str>
+def load_config(path):
+    output = subprocess.check_output(['bash', '-c', 'source "$0" && env -0', path])
+    return dict( item.split('=', 1) for item in output.decode('utf-8').split('\0') if '=' in item )
+
+class Workflow(object):
+    # void
+    def __init__(self, date, config):
+        self.date = date
+        self.dir_date = os.path.join('logs', str(date))
+        self.targets = config.get('NIGHT_SHIFT_TARGETS', '').split()
+        self.failure_targets = config.get('NIGHT_SHIFT_FAILURE_TARGETS', '').split()
+        self.jobs = int(config.get('NIGHT_SHIFT_PARALLEL_JOBS', 6))
+        self.max_attempts = int(config.get('NIGHT_SHIFT_MAX_ATTEMPTS', 23))
+        self.backoff = int(config.get('NIGHT_SHIFT_RETRY_BACKOFF', 300))
+        self.max_backoff = int(config.get('NIGHT_SHIFT_MAX_RETRY_BACKOFF', 4 * 3600))
+        self.use_scheduler = config.get('NIGHT_SHIFT_SCHEDULER') == '1'
+        self.graph = None
+        self.attempt_log = None
+
+    # str
+    def get_state_path(self):
+        return os.path.join(self.dir_date, STATE_FILE_NAME)
+
+    # dict
+    def load_state(self):
+        try:
+            with io.open(self.get_state_path(), 'r', encoding='utf-8') as fd:
+                return json.load(fd)
+        except (IOError, ValueError):
+            return None
+
+    # void
+    def save_state(self, state):
+        path = self.get_state_path()
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with io.open(tmp_path, 'wb') as fd:
+            fd.write(json.dumps(state, indent=2, sort_keys=True).encode('utf-8'))
+        os.rename(tmp_path, path)
+
+    # int
+    def get_attempt_count(self):
+        return len([ f for f in os.listdir(self.dir_date) if f.startswith('attempt-') and f.endswith('.log') ])
+
+    # dict<str,list<str>>
+    def get_graph(self):
+        if self.graph is None:
+            # The analysis of the last attempt already knows the graph, make is only asked for the first time.
+            try:
+                with io.open(os.path.join(self.dir_date, GRAPH_FILE_NAME), 'r', encoding='utf-8') as fd:
+                    targets = json.load(fd)['targets']
+                self.graph = dict( (target, info['prerequisites']) for target, info in targets.items() )
+            except (IOError, ValueError, KeyError):
+                self.graph = load_graph(self.date, self.targets)
+        return self.graph
+
+    # dict<str,dict>
+    def find_failed_targets(self):
+        commands, _ = TimingEnvLogReader(os.path.join(self.dir_date, 'timing_env.log')).read()
+
+        # The last command of a target tells whether its last run failed (or never finished).
+        last_commands = {}
+        for cmd in commands:
+            if cmd.get('has_make_level') and cmd['target'] not in self.failure_targets:
+                last_commands[cmd['target']] = cmd
+
+        return dict( (target, cmd) for target, cmd in last_commands.items() \
+            if 'finished_at' not in cmd or cmd.get('exit_code') != 0 )
+
+    # set<str>
+    def get_dependents_closure(self, targets):
+        dependents, closure, stack = get_dependents(self.get_graph()), set(), list(targets)
+        while stack:
+            target = stack.pop()
+            if target not in closure:
+                closure.add(target)
+                stack.extend(dependents.get(target, []))
+        return closure
+
+    # list<str>
+    def get_retry_goals(self, ready, waiting):
+        # The dependents of a target in backoff would build it too early.
+        goals = self.get_dependents_closure(ready) - self.get_dependents_closure(waiting)
+        graph = self.get_graph()
+
+        # Make builds the prerequisites of the goals anyway, only the top ones are passed.
+        covered = set( p for target in goals for p in graph.get(target, []) )
+        return sorted(goals - covered)
+
+    # void
+    def log(self, message):
+        self.attempt_log.write(u'{}\n'.format(message))
+        self.attempt_log.flush()
+
+    # int
+    def call(self, cmd):
+        return subprocess.call(cmd, stdout=self.attempt_log, stderr=subprocess.STDOUT)
+
+    # int
+    def make(self, args, title):
+        self.log(u'\n\n[+] Working on target {}'.format(title))
+        exit_code = self.call(['make'] + args)
+        self.log(u'\n\n[+] Completed {}'.format(title))
+        self.log(datetime.datetime.now().strftime('%a %b %d %H:%M:%S %Y'))
+        return exit_code
+
+    # int
+    def run_attempt(self, attempt_nr, goals):
+        os.environ['ATTEMPT_COUNT'] = str(attempt_nr)
+        path = os.path.join(self.dir_date, 'attempt-{:02d}.log'.format(attempt_nr))
+        with io.open(path, 'a', encoding='utf-8') as self.attempt_log:
+            self.log(u'\n\n[+] Starting attempt No {} with PID {}...'.format(attempt_nr, os.getpid()))
+            self.log(datetime.datetime.now().strftime('%a %b %d %H:%M:%S %Y'))
+
+            if attempt_nr == 0:
+                self.call([os.path.join(LIB_DIR, 'analytics.py'), 'logs'])
+
+            exit_codes = 0
+            if self.use_scheduler:
+                self.log(u'\n\n[+] Scheduling targets {}'.format(' '.join(goals)))
+                exit_codes += self.call([os.path.join(LIB_DIR, 'schedule.py'), 'run', \
+                    '--date', str(self.date), '--jobs', str(self.jobs)] + goals)
+            else:
+                exit_codes += self.make(['-k', '-j', str(self.jobs)] + goals, \
+                    '-k -j {} {}'.format(self.jobs, ' '.join(goals)))
+
+            for target in self.failure_targets:
+                exit_codes += self.make([target], target)
+
+            self.call([os.path.join(LIB_DIR, 'critical_path.py'), '--quiet', '--date', str(self.date), \
+                '--jobs', str(self.jobs)] + self.targets)
+            self.graph = None
+
+        self.attempt_log = None
+        return exit_codes
+
+    # void
+    def update_backoff(self, state, failed_targets, attempt_started_at):
+        for target in list(state['targets']):
+            if target not in failed_targets:
+                del state['targets'][target]
+
+        # Only the targets which failed again in this attempt wait longer.
+        now = time.time()
+        for target, cmd in failed_targets.items():
+            if target in state['targets'] and cmd['started_at'] < attempt_started_at:
+                continue
+
+            info = state['targets'].setdefault(target, {'failures': 0})
+            info['failures'] += 1
+            info['exit_code'] = cmd.get('exit_code')
+            info['retry_at'] = now + min(self.max_backoff, self.backoff * 2 ** (info['failures'] - 1))
+
+    # int
+    def finish(self, attempt_nr, success):
+        path = os.path.join(self.dir_date, 'attempt-{:02d}.log'.format(attempt_nr))
+        with io.open(path, 'a', encoding='utf-8') as self.attempt_log:
+            exit_code = self.make(['cleanup'], 'cleanup')
+
+        if not success or exit_code != 0:
+            print('[!] Final attempt failed, here are all the logs:')
+            for name in sorted(os.listdir(self.dir_date)):
+                if name.startswith('attempt-') and name.endswith('.log'):
+                    with io.open(os.path.join(self.dir_date, name), 'r', encoding='utf-8') as fd:
+                        print(fd.read())
+            return 1
+
+        # Tests attempts log size.
+        if subprocess.call([sys.executable, os.path.join(LIB_DIR, os.pardir, 'tests', 'attempt_log_sizes.py')]) != 0:
+            subprocess.call(['ls', '-l', self.dir_date])
+            return 1
+
+        print('Everything is ok.')
+        return 0
+
+    # list<str>
+    def get_due_targets(self, state):
+        # A retry after the end of the day would never come, the date of the next trigger is another one.
+        now = time.time()
+        end_of_day = time.mktime((self.date + datetime.timedelta(days=1)).timetuple())
+        return [ t for t, info in state['targets'].items() if info['retry_at'] <= now or info['retry_at'] >= end_of_day ]
+
+    # int
+    def run(self):
+        if not os.path.exists(self.dir_date):
+            os.makedirs(self.dir_date)
+
+        state = self.load_state() or {'finished': False, 'full_run': True, 'targets': {}}
+        attempt_nr = self.get_attempt_count()
+        if state['finished'] or attempt_nr > self.max_attempts:
+            return 0
+
+        if state['full_run']:
+            goals = self.targets
+        else:
+            ready = self.get_due_targets(state)
+            waiting = [ t for t in state['targets'] if t not in ready ]
+            goals = self.get_retry_goals(ready, waiting) if ready else []
+            if not goals:
+                # Nothing is due yet, a later trigger retries them.
+                return 0
+
+        attempt_started_at = datetime.datetime.now()
+        exit_codes = self.run_attempt(attempt_nr, goals)
+        failed_targets = self.find_failed_targets()
+        self.update_backoff(state, failed_targets, attempt_started_at)
+
+        # A failure without a failed target (e.g. a missing rule) needs a full run again.
+        state['full_run'] = exit_codes != 0 and not failed_targets
+        state['finished'] = exit_codes == 0 and not failed_targets or attempt_nr >= self.max_attempts
+        self.save_state(state)
+
+        if state['finished']:
+            return self.finish(attempt_nr, exit_codes == 0 and not failed_targets)
+
+        return 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='run_workflow', \
+        description="Runs the makefile and retries the failed targets with backoff")
+    parser.add_argument('-c', '--config', default='config/night_shift.sh', help='night-shift config of the project')
+    parser.add_argument('-d', '--date', default=str(datetime.date.today()), help='date of the run')
+    args = parser.parse_args()
+
+    # Like `cd $(dirname $0)/../..`, night-shift is usually a symlink in the project.
+    os.chdir(os.path.normpath(os.path.join(LIB_DIR, os.pardir, os.pardir)))
+    if os.path.exists('locked'):
+        sys.exit(0)
+
+    config = load_config(args.config)
+    os.environ.update(config)
+    os.environ['PATH'] = os.environ.get('PATH', '') + ':/usr/local/bin/'
+
+    if not os.path.exists('logs'):
+        os.makedirs('logs')
+
+    workflow = Workflow(datetime.datetime.strptime(args.date, "%Y-%m-%d").date(), config)
+
+    # Only one workflow runs at a time, the lock goes away with the process.
+    lock_fd = os.open(LOCK_PATH, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        if os.path.isdir(workflow.dir_date) and workflow.get_attempt_count() >= workflow.max_attempts:
+            print('[!] Max attempts ({}) reached but processing is still running!'.format(workflow.max_attempts))
+            sys.exit(1)
+        sys.exit(0)
+
+    sys.exit(workflow.run())
@@ -45,10 +45,26 @@ if ps aux | grep -v $$ | grep -v $PPID | egrep '/bin/bash.+[r]un_workflow.sh' >>
     fi
 fi
 
+# The first attempt of the day ingests the finished days into the analytics store.
+if [ $ATTEMPT_COUNT -eq 0 ]; then
+    night-shift/lib/analytics.py logs >> $THIS_ATTEMPT 2>&1
+fi
+
 # Run the main targets:
 MAKE_EXIT_CODES=0
+MAIN_TARGETS="-k -j $NIGHT_SHIFT_PARALLEL_JOBS $NIGHT_SHIFT_TARGETS"
+if [[ "$NIGHT_SHIFT_SCHEDULER" == "1" ]]; then
+    # Starts the targets on the longest predicted path first instead of the makefile order.
+    echo -e "\n\n[+] Scheduling targets ${NIGHT_SHIFT_TARGETS}" >> $THIS_ATTEMPT
+    night-shift/lib/schedule.py run --date ${DATE} --jobs $NIGHT_SHIFT_PARALLEL_JOBS $NIGHT_SHIFT_TARGETS >> $THIS_ATTEMPT 2>&1
+    MAKE_EXIT_CODES=$?
+    echo -e "\n\n[+] Completed ${NIGHT_SHIFT_TARGETS}" >> $THIS_ATTEMPT
+    date >> $THIS_ATTEMPT
+    MAIN_TARGETS=""
+fi
+
 # Make won't do anything if everything is ready
-for TARGET in "-k -j $NIGHT_SHIFT_PARALLEL_JOBS $NIGHT_SHIFT_TARGETS" $NIGHT_SHIFT_FAILURE_TARGETS; do
+for TARGET in ${MAIN_TARGETS:+"$MAIN_TARGETS"} $NIGHT_SHIFT_FAILURE_TARGETS; do
     echo -e "\n\n[+] Working on target ${TARGET}" >> $THIS_ATTEMPT
     make ${TARGET} >> $THIS_ATTEMPT 2>&1
     LAST_EXIT_CODE=$?
@@ -57,6 +73,9 @@ for TARGET in "-k -j $NIGHT_SHIFT_PARALLEL_JOBS $NIGHT_SHIFT_TARGETS" $NIGHT_SHI
     date >> $THIS_ATTEMPT
 done
 
+# Critical path and job slot utilization of the run, shown on the command gantt.
+night-shift/lib/critical_path.py --quiet --date ${DATE} --jobs $NIGHT_SHIFT_PARALLEL_JOBS $NIGHT_SHIFT_TARGETS >> $THIS_ATTEMPT 2>&1
+
 # If there were no errors at all or this is the last attempt: clean up
 if [[ "$MAKE_EXIT_CODES" -eq 0 || "$ATTEMPT_COUNT" -ge $NIGHT_SHIFT_MAX_ATTEMPTS ]]; then
     make cleanup >> $THIS_ATTEMPT 2>&1
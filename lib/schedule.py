@@ -0,0 +1,204 @@
+#!/usr/bin/env pypy
+
+from __future__ import print_function
+import os
+import sys
+import heapq
+import argparse
+import datetime
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from timing_env import TimingEnvLogReader, normalize_target
+from critical_path import parse_make_database, read_make_database, get_reachable_graph, \
+    get_topological_order, get_target_timings
+
+# dict<str,float>
+def read_durations(dir_logs, date):
+    path = os.path.join(dir_logs, str(date), 'timing_env.log')
+    if not os.path.exists(path):
+        return {}
+
+    commands, _ = TimingEnvLogReader(path).read()
+    return dict( (normalize_target(target, date), timing['duration']) \
+        for target, timing in get_target_timings(commands).items() )
+
+# dict<str,float>
+def estimate_durations(dir_logs, date, days):
+    history = {}
+    for i in range(1, days + 1):
+        for target, duration in read_durations(dir_logs, date - datetime.timedelta(days=i)).items():
+            history.setdefault(target, []).append(duration)
+
+    # The median is not thrown off by a single slow night.
+    return dict( (target, sorted(durations)[len(durations) // 2]) for target, durations in history.items() )
+
+# dict<str,list<str>>
+def get_dependents(graph):
+    dependents = dict( (target, []) for target in graph )
+    for target, prerequisites in graph.items():
+        for prerequisite in prerequisites:
+            if prerequisite in dependents:
+                dependents[prerequisite].append(target)
+    return dependents
+
+# dict<str,float>
+def get_priorities(graph, durations):
+    # Length of the longest path from the start of the target to the end of the run.
+    dependents, priorities = get_dependents(graph), {}
+    for target in reversed(get_topological_order(graph)):
+        priorities[target] = durations.get(target, 0.0) + \
+            max([ priorities[dependent] for dependent in dependents[target] if dependent in priorities ] or [0.0])
+    return priorities
+
+# dict<str,float>
+def get_make_priorities(graph, targets):
+    # Make walks the goals depth-first and starts the prerequisites in their order.
+    order, visited, stack = [], set(), [ (target, False) for target in reversed(targets) ]
+    while stack:
+        target, is_expanded = stack.pop()
+        if is_expanded:
+            order.append(target)
+        elif target not in visited:
+            visited.add(target)
+            stack.append((target, True))
+            stack.extend( (p, False) for p in reversed(graph.get(target, [])) if p in graph )
+    return dict( (target, -i) for i, target in enumerate(order) )
+
+class Scheduler(object):
+    # void
+    def __init__(self, graph, priorities):
+        self.graph = graph
+        self.priorities = priorities
+        self.dependents = get_dependents(graph)
+        self.waiting = dict( (target, set(p for p in prerequisites if p in graph)) \
+            for target, prerequisites in graph.items() )
+        self.ready = []
+        self.failed = set()
+        for target, prerequisites in list(self.waiting.items()):
+            if not prerequisites:
+                self.push_ready(target)
+
+    # void
+    def push_ready(self, target):
+        del self.waiting[target]
+        heapq.heappush(self.ready, (-self.priorities.get(target, 0.0), target))
+
+    # str
+    def pop_ready(self):
+        return heapq.heappop(self.ready)[1] if self.ready else None
+
+    # void
+    def finish(self, target, success = True):
+        if not success:
+            self.failed.add(target)
+
+        for dependent in self.dependents[target]:
+            if dependent not in self.waiting:
+                continue
+
+            # Like `make -k`: the dependents of a failed target are skipped, the rest goes on.
+            if not success:
+                del self.waiting[dependent]
+                self.finish(dependent, False)
+                continue
+
+            self.waiting[dependent].discard(target)
+            if not self.waiting[dependent]:
+                self.push_ready(dependent)
+
+# tuple<float,dict<str,float>>
+def simulate(graph, priorities, durations, jobs):
+    scheduler = Scheduler(graph, priorities)
+    now, running, started_at = 0.0, [], {}
+    while scheduler.ready or running:
+        while scheduler.ready and len(running) < jobs:
+            target = scheduler.pop_ready()
+            started_at[target] = now
+            heapq.heappush(running, (now + durations.get(target, 0.0), target))
+
+        now, target = heapq.heappop(running)
+        scheduler.finish(target)
+    return now, started_at
+
+# int
+def run(graph, priorities, jobs, make_args):
+    scheduler = Scheduler(graph, priorities)
+    running = {}
+    while scheduler.ready or running:
+        while scheduler.ready and len(running) < jobs:
+            target = scheduler.pop_ready()
+            print('[+] Starting {}'.format(target))
+            sys.stdout.flush()
+            # The finished prerequisites are only checked, make still remakes the target if they are newer.
+            process = subprocess.Popen(['make'] + make_args + [target])
+            running[process.pid] = (process, target)
+
+        pid, status = os.wait()
+        if pid not in running:
+            continue
+
+        process, target = running.pop(pid)
+        process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 1
+        if process.returncode != 0:
+            print('[!] Failed {} with exit code {}'.format(target, process.returncode))
+        scheduler.finish(target, process.returncode == 0)
+
+    # The targets of a cycle never get ready, they did not run at all.
+    for target in sorted(scheduler.waiting):
+        print('[!] Never started {}, its prerequisites were not finished'.format(target))
+
+    return 1 if scheduler.failed or scheduler.waiting else 0
+
+# dict<str,list<str>>
+def load_graph(date, targets, makefile = None):
+    graph = parse_make_database(read_make_database(date, targets, makefile))
+    return get_reachable_graph(graph, targets) if targets else graph
+
+# dict<str,float>
+def get_dated_durations(graph, durations, date):
+    return dict( (target, durations[normalize_target(target, date)]) \
+        for target in graph if normalize_target(target, date) in durations )
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='schedule', \
+        description="Starts the targets on the longest predicted path first")
+    parser.add_argument('mode', choices=['order', 'run', 'simulate'], \
+        help='print the target order, build the targets with a job pool or replay past days')
+    parser.add_argument('targets', nargs='+', help='make targets of the run, e.g. $NIGHT_SHIFT_TARGETS')
+    parser.add_argument('-d', '--date', type=lambda s: datetime.datetime.strptime(s, "%Y-%m-%d").date(), \
+        default=datetime.date.today(), help='date of the run')
+    parser.add_argument('-j', '--jobs', type=int, default=int(os.environ.get('NIGHT_SHIFT_PARALLEL_JOBS', 6)), \
+        help='number of parallel jobs')
+    parser.add_argument('-f', '--makefile', help='makefile of the project')
+    parser.add_argument('--history', type=int, default=7, help='number of previous days the durations come from')
+    parser.add_argument('--days', type=int, default=7, help='number of past days the simulation replays')
+    args = parser.parse_args()
+
+    if args.mode == 'simulate':
+        for i in range(args.days, 0, -1):
+            date = args.date - datetime.timedelta(days=i)
+            graph = load_graph(date, args.targets, args.makefile)
+            actual = get_dated_durations(graph, read_durations('logs', date), date)
+            if not actual:
+                continue
+
+            estimated = get_dated_durations(graph, estimate_durations('logs', date, args.history), date)
+            make_length, _ = simulate(graph, get_make_priorities(graph, args.targets), actual, args.jobs)
+            length, _ = simulate(graph, get_priorities(graph, estimated), actual, args.jobs)
+            print('{}: make order {:.1f}m, scheduled {:.1f}m, gain {:.1f}m ({:.0%})'.format(date, \
+                make_length / 60, length / 60, (make_length - length) / 60, \
+                (make_length - length) / make_length if make_length else 0))
+        sys.exit(0)
+
+    graph = load_graph(args.date, args.targets, args.makefile)
+    durations = get_dated_durations(graph, estimate_durations('logs', args.date, args.history), args.date)
+    priorities = get_priorities(graph, durations)
+
+    if args.mode == 'order':
+        for target in sorted(graph, key = lambda t: (-priorities[t], t)):
+            print('{:10.1f}m  {}'.format(priorities[target] / 60, target))
+        sys.exit(0)
+
+    make_args = ['-k', 'TODAY={}'.format(args.date)] + (['-f', args.makefile] if args.makefile else [])
+    sys.exit(run(graph, priorities, args.jobs, make_args))
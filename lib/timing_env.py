@@ -0,0 +1,181 @@
+import os
+import io
+import json
+import datetime
+import threading
+
+# datetime
+def parse_timestamp(value):
+    # tracking_shell writes `datetime.isoformat()`: YYYY-MM-DDTHH:MM:SS[.ffffff]
+    if len(value) in (19, 26) and value[10] == 'T':
+        try:
+            return datetime.datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                int(value[11:13]), int(value[14:16]), int(value[17:19]),
+                int(value[20:26]) if len(value) == 26 else 0)
+        except ValueError:
+            pass
+
+    from dateutil.parser import parse as parse_datetime
+    return parse_datetime(value)
+
+# Placeholder of the date in the target names, so they match between days.
+DATE_PLACEHOLDER = '$(TODAY)'
+
+# str
+def normalize_target(target, date):
+    return target.replace(str(date), DATE_PLACEHOLDER)
+
+class TimingEnvCommands(object):
+    # void
+    def __init__(self):
+        self.commands = {}
+        self.ordered_commands = []
+        self.errors = set()
+        self.attempts = {}
+        self.first_started_at = None
+        self.changelog = []
+
+    # void
+    def add_begin(self, cmd_hash_key, data):
+        command = dict(data)
+        command['tags'] = [data['tag']]
+        command['started_at'] = parse_timestamp(data['started_at'])
+        command['date'] = command['started_at'].date()
+
+        if self.first_started_at is None:
+            self.first_started_at = command['started_at']
+        command['waited'] = (command['started_at']-self.first_started_at).total_seconds() / 60
+
+        attempt_key = (command['target'], command['command'])
+        self.attempts[attempt_key] = self.attempts.get(attempt_key, 0) + 1
+        command['attempt_nr'] = self.attempts[attempt_key]
+
+        self.commands[cmd_hash_key] = command
+        self.ordered_commands.append(command)
+
+    # void
+    def add_end(self, command, data):
+        started_at = command['started_at']
+        command.update(data)
+        command['tags'].append(data['tag'])
+        command['started_at'] = started_at
+        command['finished_at'] = parse_timestamp(data['finished_at'])
+        command['length'] = (command['finished_at']-started_at).total_seconds() / 60
+
+    # void
+    def add(self, data):
+        cmd_hash_key = (data.get('command'), data.get('unique_nr'))
+        command = self.commands.get(cmd_hash_key)
+
+        if command is None and data.get('tag') == 'BEGIN':
+            self.add_begin(cmd_hash_key, data)
+            self.changelog.append(cmd_hash_key)
+
+        elif command is not None and data.get('tag') in command['tags']:
+            self.errors.add('Found duplicated command: {}'.format(data.get('command')))
+
+        elif command is not None and data.get('tag') == 'END':
+            self.add_end(command, data)
+            self.changelog.append(cmd_hash_key)
+
+        else:
+            self.errors.add('Unknown error: {}'.format(data.get('command')))
+
+    # tuple<list<dict>,set<str>>
+    def snapshot(self):
+        return [ dict(command) for command in self.ordered_commands ], set(self.errors)
+
+    # int
+    def get_position(self):
+        return len(self.changelog)
+
+    # tuple<list<dict>,int>
+    def changes_since(self, position):
+        changed_keys, changes = set(), []
+        for cmd_hash_key in self.changelog[position:]:
+            if cmd_hash_key not in changed_keys:
+                changed_keys.add(cmd_hash_key)
+                changes.append(dict(self.commands[cmd_hash_key]))
+        return changes, len(self.changelog)
+
+class TimingEnvLogReader(object):
+    # void
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.generation, self.offset = 0, 0
+        self.reset()
+
+    # void
+    def reset(self, inode = None):
+        # Consumers have to drop everything derived from the consumed content.
+        if self.offset:
+            self.generation += 1
+
+        self.inode = inode
+        self.offset = 0
+        self.commands = TimingEnvCommands()
+
+    # bool
+    def is_rotated(self, stat):
+        return stat.st_ino != self.inode or stat.st_size < self.offset
+
+    # list<dict>
+    def parse_lines(self, chunk):
+        records = []
+        for line in chunk.split(b'\n'):
+            try:
+                records.append(json.loads(line.decode('utf-8')))
+            except ValueError:
+                continue
+        return records
+
+    # list<dict>
+    def read_new_records(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            self.reset()
+            return []
+
+        if self.is_rotated(stat):
+            self.reset(stat.st_ino)
+
+        if stat.st_size == self.offset:
+            return []
+
+        with io.open(self.path, 'rb') as fd:
+            fd.seek(self.offset)
+            chunk = fd.read(stat.st_size - self.offset)
+
+        # Only consume complete lines, the last one could be still written.
+        last_newline = chunk.rfind(b'\n')
+        if last_newline == -1:
+            return []
+
+        self.offset += last_newline + 1
+        records = self.parse_lines(chunk[:last_newline])
+        for record in records:
+            self.commands.add(record)
+        return records
+
+    # tuple<list<dict>,set<str>>
+    def read(self):
+        with self.lock:
+            self.read_new_records()
+            return self.commands.snapshot()
+
+    # tuple<int,int>
+    def get_position(self):
+        with self.lock:
+            return self.generation, self.commands.get_position()
+
+    # tuple<int,int,list<dict>>
+    def read_changes(self, generation = None, position = 0):
+        with self.lock:
+            self.read_new_records()
+            if generation != self.generation:
+                position = 0
+
+            changes, position = self.commands.changes_since(position)
+            return self.generation, position, changes
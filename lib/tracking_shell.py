@@ -5,38 +5,261 @@ import re
 import io
 import sys
 import json
-import random
+import binascii
 import datetime
 import logging
+import subprocess
 import trackingshell as ts
 
+# The shared modules of night-shift live next to this file.
+LIB_DIR = os.path.dirname(os.path.abspath(__file__))
+if LIB_DIR not in sys.path:
+    sys.path.append(LIB_DIR)
+
 class MakeTarget(ts.MakeTarget):
+    RE_LOG_DIRECTORY_TARGET = re.compile(r'^logs/\d{4}-\d{2}-\d{2}$')
+    RE_LOG_TARGET = re.compile(r'^logs/\d{4}-\d{2}-\d{2}/.*$')
+    RE_RESULTS_TARGET = re.compile(r'^results/\d{4}-\d{2}-\d{2}/.*$')
+    RE_SQL_DIALECT = re.compile(r'run_sql_template\.rb\b.*?\s(?:-d|--dialect)[\s=]+(\w+)')
+    OUTPUT_BUFFER_SIZE = 1024 * 1024
+    LOG_COMPRESSION_MIN_SIZE = 1024 * 1024
+    log_path = None
+    output_bytes = None
+    resource = None
+    resource_wait = None
+    resource_usage = None
+    profiles = None
+    worker = None
+    queue_wait = None
+
     # void
     def set_logger(self):
         log_dir = 'logs/{}'.format(str(self.date))
         if not os.path.exists(log_dir): return
 
-        handler = logging.FileHandler(os.path.join(log_dir, 'trackingshell.log'))
+        # Most commands never log a warning, so the file is opened on the first record.
+        handler = logging.FileHandler(os.path.join(log_dir, 'trackingshell.log'), delay=True)
         handler.setFormatter(logging.Formatter('%(levelname)s\t%(asctime)s\t%(name)s\t%(target)s\t%(command)s\t%(message)s'))
         self.logger.setLevel(logging.WARNING)
         self.logger.addHandler(handler)
 
     # bool
     def is_log_directory_target(self):
-        return bool(re.match(r'^logs/\d{4}-\d{2}-\d{2}$', self.target))
+        return bool(self.RE_LOG_DIRECTORY_TARGET.match(self.target))
 
     # bool
     def is_log_target(self):
-        return bool(re.match(r'^logs/\d{4}-\d{2}-\d{2}/.*$', self.target))
+        return bool(self.RE_LOG_TARGET.match(self.target))
 
     # bool
     def is_results_target(self):
-        return bool(re.match(r'^results/\d{4}-\d{2}-\d{2}/.*$', self.target))
+        return bool(self.RE_RESULTS_TARGET.match(self.target))
 
     # bool
     def is_big_data_file(self):
         return self.target.endswith((".gz", ".csv", ".json", ".zip", ".xml"))
 
+    # str
+    def get_resource(self):
+        # Declared by the target (`RESOURCE` variable) or the database of the SQL template.
+        if self.resource:
+            return self.resource
+
+        match = self.RE_SQL_DIALECT.search(self.command)
+        return match.group(1) if match else None
+
+    # int
+    def get_resource_limit(self, resource):
+        # e.g. NIGHT_SHIFT_RESOURCES="redshift:2 mysql:4", the rest is unlimited.
+        for item in os.environ.get('NIGHT_SHIFT_RESOURCES', '').split():
+            name, _, limit = item.partition(':')
+            if name == resource and limit.isdigit():
+                return int(limit)
+        return None
+
+    # bool
+    def should_profile(self):
+        # e.g. NIGHT_SHIFT_PROFILE="results/%/users.csv script/%", `%` matches anything.
+        for pattern in os.environ.get('NIGHT_SHIFT_PROFILE', '').split():
+            if re.match('^{}$'.format('.*'.join(map(re.escape, pattern.split('%')))), self.target):
+                return True
+        return False
+
+    # bool
+    def use_output_multiplexer(self):
+        # The output of a remote command comes back through the tracking shell anyway.
+        return os.environ.get('NIGHT_SHIFT_OUTPUT_MULTIPLEXER', '0') == '1' or self.use_executor()
+
+    # bool
+    def use_executor(self):
+        # e.g. NIGHT_SHIFT_EXECUTOR="localhost:7010", the coordinator of `executor.py`.
+        return bool(os.environ.get('NIGHT_SHIFT_EXECUTOR')) and self.has_makelevel()
+
+    # bool
+    def use_log_compression(self):
+        if os.environ.get('NIGHT_SHIFT_LOG_COMPRESSION') not in ('gzip', 'zstd'):
+            return False
+
+        return self.is_big_data_file() or \
+            os.path.getsize(self.log_path) >= self.LOG_COMPRESSION_MIN_SIZE
+
+    # void
+    def compress_log(self):
+        import log_storage
+        try:
+            log_storage.compress(self.log_path, os.environ['NIGHT_SHIFT_LOG_COMPRESSION'])
+        except (IOError, OSError, ValueError) as e:
+            self.logger.error(u'Could not compress target log `{}`: {}'.format(self.log_path, e), \
+                extra = self.as_dict())
+
+    # str
+    def set_metrics_path(self, unique_nr):
+        # The commands append JSON lines to it, e.g. the throughput of an SQL export.
+        # Most of them write none, the file is created by the first line.
+        path = os.path.abspath('logs/{}/metrics-{}.jsonl'.format(self.date, unique_nr))
+        os.environ['NIGHT_SHIFT_METRICS_FILE'] = path
+        return path
+
+    # dict
+    def read_metrics_file(self, path):
+        metrics = {}
+        try:
+            with io.open(path, 'r', encoding='utf-8') as fd:
+                for line in fd:
+                    try:
+                        metrics.update(json.loads(line))
+                    except ValueError:
+                        self.logger.warning(u'Invalid metrics line `{}`'.format(line.strip()), extra = self.as_dict())
+            os.remove(path)
+        except (IOError, OSError):
+            pass
+        return metrics
+
+    # int
+    def wait_process(self, process):
+        self.resource_usage = wait_process_usage(process)
+        return process.returncode
+
+    # int
+    def execute_command(self):
+        if self.use_executor():
+            exit_code = self.execute_remote_command()
+            if exit_code is not None:
+                return exit_code
+
+        if not self.log_path or not self.use_output_multiplexer():
+            process = subprocess.Popen(["/bin/bash", "-e", "-o", "pipefail", "-c", self.command])
+            return self.wait_process(process)
+
+        process = subprocess.Popen(["/bin/bash", "-e", "-o", "pipefail", "-c", self.command],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        try:
+            self.multiplex_output(iter(lambda: os.read(process.stdout.fileno(), self.OUTPUT_BUFFER_SIZE), b''))
+        finally:
+            process.stdout.close()
+
+        return self.wait_process(process)
+
+    # void
+    def multiplex_output(self, chunks):
+        # Same as `(command) 2>&1 | tee -a log_path` without the extra process and pipe.
+        self.output_bytes, self.output_lines = 0, 0
+
+        log_fd = os.open(self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644) if self.log_path else None
+        stdout_fd = sys.stdout.fileno()
+        try:
+            for chunk in chunks:
+                self.output_bytes += len(chunk)
+                self.output_lines += chunk.count(b'\n')
+                if log_fd is not None:
+                    write_all(log_fd, chunk)
+                if stdout_fd is not None:
+                    try:
+                        write_all(stdout_fd, chunk)
+                    except OSError:
+                        stdout_fd = None
+        finally:
+            if log_fd is not None:
+                os.close(log_fd)
+
+    # int
+    def execute_remote_command(self):
+        import executor
+
+        try:
+            job = executor.RemoteJob(os.environ['NIGHT_SHIFT_EXECUTOR'], executor.get_token(os.environ), {
+                'target': self.target,
+                'command': self.command,
+                'date': str(self.date),
+                'cwd': os.getcwd(),
+                'env': executor.get_forwarded_env(os.environ)
+            })
+        except (IOError, OSError, ValueError) as e:
+            self.logger.warning(u'Could not submit to the executor, running locally: {}'.format(e), \
+                extra = self.as_dict())
+            return None
+
+        with job:
+            self.multiplex_output(job.iter_output())
+
+        self.worker, self.queue_wait = job.worker, job.queue_wait
+        if job.result is None or job.result.get('exit_code') is None:
+            self.logger.error(u'Remote command was lost: {}'.format(job.result.get('error') \
+                if job.result else 'connection to the executor was closed'), extra = self.as_dict())
+            return executor.LOST_EXIT_CODE
+
+        # The metrics were written on the worker, the rest of the command's END record gets them here.
+        metrics_path = os.environ.get('NIGHT_SHIFT_METRICS_FILE')
+        if job.result.get('metrics') and metrics_path:
+            with io.open(metrics_path, 'a', encoding='utf-8') as fd:
+                fd.write(u''.join(job.result['metrics']))
+
+        self.resource_usage = job.result.get('usage')
+        return job.result['exit_code']
+
+# dict
+def read_process_io(pid):
+    # Readable until the process is reaped, it contains the reaped children as well.
+    try:
+        with io.open('/proc/{}/io'.format(pid), 'rb') as fd:
+            fields = dict( line.split(b':') for line in fd.read().splitlines() if b':' in line )
+    except (IOError, OSError):
+        return {}
+
+    return {
+        'read_bytes': int(fields.get(b'read_bytes', 0)),
+        'write_bytes': int(fields.get(b'write_bytes', 0))
+    }
+
+# dict
+def wait_process_usage(process):
+    process_io = {}
+    if hasattr(os, 'waitid'):
+        try:
+            os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+            process_io = read_process_io(process.pid)
+        except OSError:
+            pass
+
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+
+    # `ru_maxrss` is in bytes on Mac and in kilobytes elsewhere.
+    resource_usage = {
+        'cpu_user': round(rusage.ru_utime, 3),
+        'cpu_sys': round(rusage.ru_stime, 3),
+        'max_rss_kb': rusage.ru_maxrss // 1024 if sys.platform == 'darwin' else rusage.ru_maxrss,
+        'block_in': rusage.ru_inblock,
+        'block_out': rusage.ru_oublock
+    }
+    resource_usage.update(process_io)
+    return resource_usage
+
+# void
+def write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
 @ts.only_run_in_make_level
 @ts.plugin
 def target_plugin(mt, next_plugin_fn):
@@ -52,7 +275,10 @@ def target_plugin(mt, next_plugin_fn):
                 fd.write(u"\n[tracking_shell {}] Working on target {} attempt {} command {}\n\n" \
                     .format(datetime.datetime.now(), mt.target, attempt_nr, repr(mt.command)))
                 fd.flush()
-            mt.command = "({}) 2>&1 | tee -a {}".format(mt.command, path)
+
+            mt.log_path = path
+            if not mt.use_output_multiplexer():
+                mt.command = "({}) 2>&1 | tee -a {}".format(mt.command, path)
 
         except IOError:
             mt.logger.error(u'Could not open target log `{}`'.format(path), extra = mt.as_dict())
@@ -60,40 +286,214 @@ def target_plugin(mt, next_plugin_fn):
 
     return next_plugin_fn(mt)
 
+@ts.plugin
+def log_compression_plugin(mt, next_plugin_fn):
+    exit_code = next_plugin_fn(mt)
+
+    # The END record is written by now, so the compression is not part of the command's length.
+    if mt.log_path and mt.use_log_compression():
+        mt.compress_log()
+
+    return exit_code
+
+class ResourceSlot(object):
+    LOCK_DIRECTORY = 'logs/locks'
+    POLL_INTERVAL = 0.1
+    MAX_POLL_INTERVAL = 1.0
+
+    # void
+    def __init__(self, resource, limit):
+        self.resource = resource
+        self.limit = limit
+        self.fd = None
+
+    # str
+    def get_lock_path(self, slot_nr):
+        return os.path.join(self.LOCK_DIRECTORY, '{}.{}.lock'.format(self.resource, slot_nr))
+
+    # bool
+    def try_lock(self, slot_nr):
+        import fcntl
+
+        fd = os.open(self.get_lock_path(slot_nr), os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            os.close(fd)
+            return False
+
+        self.fd = fd
+        return True
+
+    # float
+    def acquire(self):
+        import time
+
+        if not os.path.exists(self.LOCK_DIRECTORY):
+            try:
+                os.makedirs(self.LOCK_DIRECTORY)
+            except OSError:
+                pass
+
+        # The kernel drops the lock with the process, so a killed target never leaks a slot.
+        started_at, interval = time.time(), self.POLL_INTERVAL
+        while True:
+            for slot_nr in range(self.limit):
+                if self.try_lock(slot_nr):
+                    return time.time() - started_at
+
+            time.sleep(interval)
+            interval = min(interval * 2, self.MAX_POLL_INTERVAL)
+
+    # void
+    def release(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+@ts.plugin
+def resource_plugin(mt, next_plugin_fn):
+    resource = mt.get_resource()
+    limit = mt.get_resource_limit(resource) if resource else None
+    if not limit:
+        return next_plugin_fn(mt)
+
+    slot = ResourceSlot(resource, limit)
+    try:
+        mt.resource, mt.resource_wait = resource, slot.acquire()
+    except (IOError, OSError) as e:
+        mt.logger.error(u'Could not lock resource `{}`: {}'.format(resource, e), extra = mt.as_dict())
+        return next_plugin_fn(mt)
+
+    try:
+        return next_plugin_fn(mt)
+    finally:
+        slot.release()
+
+@ts.only_run_in_make_level
+@ts.plugin
+def profile_plugin(mt, next_plugin_fn):
+    if not mt.should_profile():
+        return next_plugin_fn(mt)
+
+    profile_dir = 'logs/{}/profiles'.format(mt.date)
+    try:
+        if not os.path.exists(profile_dir):
+            os.makedirs(profile_dir)
+    except OSError as e:
+        mt.logger.error(u'Could not create profile directory: {}'.format(e), extra = mt.as_dict())
+        return next_plugin_fn(mt)
+
+    # Every Python and Ruby process of the recipe writes `<prefix>.<pid>.<ext>` when it exits.
+    prefix = '{}.{}-{}'.format(mt.target.replace('/', '_'), datetime.datetime.now().strftime('%H%M%S'), os.getpid())
+    profiling_dir = os.path.join(LIB_DIR, 'profiling')
+    os.environ.update({
+        'NIGHT_SHIFT_PROFILE_DIR': os.path.abspath(profile_dir),
+        'NIGHT_SHIFT_PROFILE_PREFIX': prefix,
+        'PYTHONPATH': os.pathsep.join(filter(None, [profiling_dir, os.environ.get('PYTHONPATH')])),
+        'RUBYOPT': ' '.join(filter(None, [os.environ.get('RUBYOPT'), '-r{}'.format(os.path.join(profiling_dir, 'profile.rb'))]))
+    })
+
+    exit_code = next_plugin_fn(mt)
+    mt.profiles = sorted( f for f in os.listdir(profile_dir) if f.startswith(prefix + '.') )
+    return exit_code
+
+class TimingEventWriter(object):
+    # void
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    # TimingEventWriter
+    def open(self):
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        return self
+
+    # TimingEventWriter
+    def __enter__(self):
+        return self
+
+    # void
+    def __exit__(self, *args):
+        os.close(self.fd)
+
+    # str
+    @staticmethod
+    def get_unique_id():
+        return '{}-{}'.format(os.getpid(), binascii.hexlify(os.urandom(8)).decode('ascii'))
+
+    # bool
+    def write(self, data):
+        # One write per record: O_APPEND keeps parallel appenders from interleaving.
+        line = u"{}\n".format(json.dumps(data)).encode('utf-8')
+        try:
+            write_all(self.fd, line)
+        except OSError:
+            return False
+
+        return True
+
 @ts.plugin
 def timing_env_plugin(mt, next_plugin_fn):
     try:
-        with io.open("logs/{}/timing_env.log".format(mt.date), "a", encoding = 'utf-8') as fd:
-            data = {
-                'command': mt.command.replace('\n', ''),
-                'target': mt.target,
-                'unique_nr': random.randint(0, 1000000),
-                'has_make_level': mt.has_makelevel(),
-                'started_at': datetime.datetime.now().isoformat(),
-                'tag': 'BEGIN'
-            }
-            fd.write(u"{}\n".format(json.dumps(data)))
-            fd.flush()
-
-            exit_code = next_plugin_fn(mt)
+        writer = TimingEventWriter("logs/{}/timing_env.log".format(mt.date)).open()
+    except (IOError, OSError):
+        return next_plugin_fn(mt)
 
+    with writer:
+        data = {
+            'command': mt.command.replace('\n', ''),
+            'target': mt.target,
+            'unique_nr': writer.get_unique_id(),
+            'has_make_level': mt.has_makelevel(),
+            'started_at': datetime.datetime.now().isoformat(),
+            'tag': 'BEGIN'
+        }
+        if mt.resource_wait is not None:
+            # The command starts after the slot is locked, so the wait is not part of its length.
             data.update({
-                'tag': 'END',
-                'finished_at': datetime.datetime.now().isoformat(),
-                'exit_code': exit_code
+                'resource': mt.resource,
+                'resource_wait': round(mt.resource_wait, 3)
             })
-            fd.write(u"{}\n".format(json.dumps(data)))
-            fd.flush()
-    
-    except IOError:
+        writer.write(data)
+
+        metrics_path = mt.set_metrics_path(data['unique_nr'])
         exit_code = next_plugin_fn(mt)
+        metrics = mt.read_metrics_file(metrics_path)
+
+        data.update({
+            'tag': 'END',
+            'finished_at': datetime.datetime.now().isoformat(),
+            'exit_code': exit_code
+        })
+        if mt.output_bytes is not None:
+            data.update({
+                'output_bytes': mt.output_bytes,
+                'output_lines': mt.output_lines
+            })
+        if mt.resource_usage is not None:
+            data.update(mt.resource_usage)
+        if metrics:
+            data['metrics'] = metrics
+        if mt.profiles:
+            data['profiles'] = mt.profiles
+        if mt.worker is not None:
+            data.update({
+                'worker': mt.worker,
+                'queue_wait': mt.queue_wait
+            })
+        writer.write(data)
 
     return exit_code
 
 if __name__ == '__main__':
     shell = ts.Shell(sys.argv[1:])
     shell.parser.add_argument('-d', '--date', help="current date")
+    shell.parser.add_argument('-r', '--resource', help="resource of the target limited by NIGHT_SHIFT_RESOURCES")
     shell.cls = MakeTarget
+    shell.plugins.register(log_compression_plugin)
+    shell.plugins.register(resource_plugin)
     shell.plugins.register(timing_env_plugin)
     shell.plugins.register(target_plugin)
+    shell.plugins.register(profile_plugin)
     shell.delegate()
\ No newline at end of file
@@ -0,0 +1,195 @@
+from __future__ import print_function
+import io
+import os
+import re
+import glob
+import json
+import hashlib
+import multiprocessing
+
+# Shared parts of the static checks: one walk of the script tree, a process
+# pool for the content scans and a cache of the scan results between runs.
+
+# Below this the pool costs more than it saves.
+MIN_POOL_ITEMS = 16
+
+# list
+def map_parallel(fn, items, processes = None, chunksize = 8):
+    items = list(items)
+    if len(items) < MIN_POOL_ITEMS or processes == 1:
+        return [ fn(item) for item in items ]
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(fn, items, chunksize = chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
+# str
+def get_content_hash(content):
+    return hashlib.sha1(content).hexdigest()
+
+# str
+def translate_glob(pattern):
+    # Like `fnmatch.translate`, but the wildcards stay in one directory, like `glob.glob`.
+    i, n, result = 0, len(pattern), []
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            result.append('[^/]*')
+        elif c == '?':
+            result.append('[^/]')
+        elif c == '[':
+            j = pattern.find(']', i + 1)
+            if j == -1:
+                result.append(re.escape(c))
+            else:
+                stuff = pattern[i:j].replace('\\', '\\\\')
+                result.append('[^{}]'.format(stuff[1:]) if stuff.startswith('!') else '[{}]'.format(stuff))
+                i = j + 1
+        else:
+            result.append(re.escape(c))
+    return '^{}$'.format(''.join(result))
+
+class FileIndex(object):
+    RE_WILDCARD = re.compile(r'[\*\?\[]')
+
+    # void
+    def __init__(self, directory, extensions):
+        self.directory = os.path.abspath(directory)
+        self.files = set()
+        self.files_by_directory = {}
+        self.outside_cache = {}
+        for root, dirs, files in os.walk(self.directory):
+            for f in files:
+                if f.endswith(tuple(extensions)):
+                    self.add(os.path.join(root, f))
+
+    # void
+    def add(self, path):
+        self.files.add(path)
+        self.files_by_directory.setdefault(os.path.dirname(path), set()).add(path)
+
+    # bool
+    def is_inside(self, path):
+        return path == self.directory or path.startswith(self.directory + os.sep)
+
+    # set<str>
+    def glob(self, pattern):
+        pattern = os.path.abspath(pattern)
+        if not self.is_inside(pattern):
+            # Rare, and the results are the same for the whole run.
+            if pattern not in self.outside_cache:
+                self.outside_cache[pattern] = set(glob.glob(pattern))
+            return self.outside_cache[pattern]
+
+        if not self.RE_WILDCARD.search(pattern):
+            return set([pattern]) if pattern in self.files else set()
+
+        # Only the files of the directory are checked, unless the directory has a wildcard as well.
+        directory, _ = os.path.split(pattern)
+        candidates = self.files if self.RE_WILDCARD.search(directory) else self.files_by_directory.get(directory, ())
+        re_pattern = re.compile(translate_glob(pattern))
+        return set( path for path in candidates if re_pattern.match(path) )
+
+class ContentCache(object):
+    # void
+    def __init__(self, path, version):
+        self.path = path
+        self.version = version
+        self.files = {}
+        self.load()
+
+    # void
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+
+        try:
+            with io.open(self.path, 'r', encoding='utf-8') as fd:
+                cache = json.load(fd)
+            if cache['version'] == self.version:
+                self.files = cache['files']
+        except (IOError, ValueError, KeyError):
+            self.files = {}
+
+    # void
+    def save(self):
+        if not self.path or not os.path.isdir(os.path.dirname(os.path.abspath(self.path))):
+            return
+
+        # Deleted files are forgotten.
+        files = dict( (path, cached) for path, cached in self.files.items() \
+            if 'result' in cached and os.path.exists(path) )
+
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with io.open(tmp_path, 'wb') as fd:
+            fd.write(json.dumps({'version': self.version, 'files': files}).encode('utf-8'))
+        os.rename(tmp_path, self.path)
+
+    # list<float>
+    def get_signature(self, path):
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime]
+
+    # void
+    def update(self, paths, fn, processes = None):
+        # Unchanged files are not even read, touched ones are only hashed.
+        stale = []
+        for path in set(paths):
+            cached = self.files.get(path)
+            if cached is None or cached['signature'] != self.get_signature(path):
+                stale.append((fn, path, cached['hash'] if cached else None))
+
+        for path, content_hash, result in map_parallel(process_file, sorted(stale), processes):
+            cached = self.files.setdefault(path, {})
+            cached.update({'signature': self.get_signature(path), 'hash': content_hash})
+            if result is not None:
+                cached['result'] = result
+
+    # object
+    def get(self, path):
+        return self.files[path]['result']
+
+# tuple<str,str,object>
+def process_file(item):
+    fn, path, previous_hash = item
+    with io.open(path, 'rb') as fd:
+        content = fd.read()
+
+    content_hash = get_content_hash(content)
+    if content_hash == previous_hash:
+        return path, content_hash, None
+    return path, content_hash, fn(path, content.decode('utf-8'))
+
+# str
+def translate_make_pattern(pattern):
+    # `%` is the stem of a pattern rule, the rest is literal.
+    return '^{}$'.format('.+'.join( re.escape(part) for part in pattern.split('%') ))
+
+class PatternMatcher(object):
+    # void
+    def __init__(self, patterns):
+        # The patterns are grouped by their text before the `%`, so a value is only matched
+        # against the patterns whose prefix it starts with, instead of all of them.
+        self.patterns_by_prefix = {}
+        for pattern in patterns:
+            normalized = pattern.rstrip('/')
+            self.patterns_by_prefix.setdefault(normalized.split('%', 1)[0], []) \
+                .append((pattern, re.compile(translate_make_pattern(normalized))))
+        self.prefix_lengths = sorted(set( len(prefix) for prefix in self.patterns_by_prefix ))
+
+    # set<str>
+    def find_matching(self, values):
+        matched = set()
+        for value in values:
+            for length in self.prefix_lengths:
+                if length > len(value):
+                    break
+
+                for pattern, re_pattern in self.patterns_by_prefix.get(value[:length], ()):
+                    if pattern not in matched and re_pattern.match(value):
+                        matched.add(pattern)
+        return matched
@@ -1,10 +1,37 @@
 from __future__ import print_function
+import io
 import os
 import sys
-import glob
+import json
 import argparse
 import datetime
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'lib'))
+import log_storage
+from analytics import median
+from timing_env import TimingEnvLogReader, normalize_target
+from critical_path import get_target_timings
+
+SUMMARY_FILE_NAME = 'day_summary.json'
+
+# Bump it when the summary changes, the old ones are computed again.
+SUMMARY_VERSION = 2
+
+# Logs of night-shift itself, the rest are target logs.
+OWN_LOGS = ('timing_env.log', 'trackingshell.log')
+
+# Direction of the anomalies and the smallest change worth a report, per metric.
+METRICS = {
+    'attempt_log_size': ('both', 0),
+    'log_size': ('both', 1024 * 1024),
+    'output_bytes': ('both', 1024 * 1024),
+    'output_lines': ('both', 10000),
+    'duration': ('above', 5 * 60)
+}
+
+# Scales the median absolute deviation to the standard deviation of a normal distribution.
+MAD_SCALE = 1.4826
+
 # datetime.date
 def valid_date(s):
     try:
@@ -14,48 +41,160 @@ def valid_date(s):
         msg = "Not a valid date: `{}`.".format(s)
         raise argparse.ArgumentTypeError(msg)
 
-# float
-def median(lst):
-    if not lst:
-        return None
-    elif len(lst) % 2 == 1:
-        return sorted(lst)[((len(lst)+1)/2)-1]
-    else:
-        return float(sum(sorted(lst)[(len(lst)/2)-1:(len(lst)/2)+1]))/2.0
+# dict<str,dict<str,float>>
+def get_target_metrics(dir_date, date):
+    commands, _ = TimingEnvLogReader(os.path.join(dir_date, 'timing_env.log')).read()
+    metrics = dict( (normalize_target(target, date), {'duration': round(timing['duration'], 3)}) \
+        for target, timing in get_target_timings(commands).items() )
 
-# list<int>
-def get_log_size_for_date(date):
-    return sum(map(os.path.getsize, map(os.path.abspath, glob.glob("logs/{}/attempt-*.log".format(str(date))))))
+    # The output of the last run of each command, only known with the output multiplexer.
+    last_commands = {}
+    for cmd in commands:
+        if cmd.get('has_make_level') and 'output_bytes' in cmd:
+            last_commands[(cmd['target'], cmd['command'])] = cmd
+
+    for (target, _), cmd in last_commands.items():
+        target_metrics = metrics.setdefault(normalize_target(target, date), {})
+        for metric in ('output_bytes', 'output_lines'):
+            target_metrics[metric] = target_metrics.get(metric, 0) + cmd.get(metric, 0)
+    return metrics
 
 # list<int>
-def get_log_size_for_last_week(date):
-    return filter(lambda v: v, [ get_log_size_for_date(date - datetime.timedelta(days=i)) for i in range(7) ])
+def get_logs_signature(paths):
+    # Number and total size of the logs, they only grow until the day is finished.
+    return [len(paths), sum( log_storage.get_size(path) for path in paths )]
+
+# dict
+def get_day_summary(dir_date, date, paths):
+    summary = {'version': SUMMARY_VERSION, 'date': str(date), 'attempt_log_size': 0, 'logs': {}, \
+        'signature': get_logs_signature(paths)}
+    for path in paths:
+        name = os.path.basename(path)
+        if name.startswith('attempt-'):
+            summary['attempt_log_size'] += log_storage.get_size(path)
+        elif name not in OWN_LOGS:
+            summary['logs'][normalize_target(name, date)] = {'log_size': log_storage.get_size(path)}
+
+    summary['targets'] = get_target_metrics(dir_date, date)
+    return summary
+
+# void
+def save_day_summary(path, summary):
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with io.open(tmp_path, 'wb') as fd:
+        fd.write(json.dumps(summary, indent=2, sort_keys=True).encode('utf-8'))
+    os.rename(tmp_path, path)
+
+# dict
+def load_day_summary(date, is_finished = True):
+    dir_date = 'logs/{}'.format(str(date))
+    if not os.path.isdir(dir_date):
+        return None
+
+    # A finished day never changes, its logs are only read again when the summary was made
+    # before the day was over (e.g. the last attempt ran the check, then came the backups).
+    path = os.path.join(dir_date, SUMMARY_FILE_NAME)
+    paths = log_storage.list_logs(dir_date)
+    if is_finished and os.path.exists(path):
+        try:
+            with io.open(path, 'r', encoding='utf-8') as fd:
+                summary = json.load(fd)
+            if summary.get('version') == SUMMARY_VERSION and summary.get('signature') == get_logs_signature(paths):
+                return summary
+        except (IOError, ValueError):
+            pass
 
-# tuple<int,int,int>
-def get_median_thresholds(lst):
-    median_value = median(lst)
-    return int(median_value * 0.9), int(median_value), int(median_value * 1.15)
+    summary = get_day_summary(dir_date, date, paths)
+    save_day_summary(path, summary)
+    return summary
+
+# dict<tuple<str,str>,float>
+def get_series(summary):
+    series = {('attempt logs', 'attempt_log_size'): summary['attempt_log_size']} \
+        if summary['attempt_log_size'] else {}
+    for group in ('logs', 'targets'):
+        for subject, metrics in summary[group].items():
+            for metric, value in metrics.items():
+                series[(subject, metric)] = value
+    return series
+
+# dict
+def check_value(value, history, metric, threshold, min_change):
+    direction, min_difference = METRICS[metric]
+    history = sorted(history)
+    center = median(history)
+    spread = MAD_SCALE * median(sorted( abs(v - center) for v in history ))
+
+    # Robust z-score: a few abnormal days in the window do not move the median and the MAD.
+    difference = value - center
+    if direction == 'above' and difference <= 0:
+        return None
+    if abs(difference) <= threshold * spread or abs(difference) < min_difference or \
+            abs(difference) <= min_change * center:
+        return None
+
+    return {'median': center, 'spread': spread, 'value': value, \
+        'change': difference / float(center) if center else None}
+
+# list<dict>
+def find_anomalies(date, window, threshold, min_change, min_history):
+    history = {}
+    for i in range(window, 0, -1):
+        summary = load_day_summary(date - datetime.timedelta(days=i))
+        if summary is None:
+            continue
+
+        for key, value in get_series(summary).items():
+            history.setdefault(key, []).append(value)
+
+    summary = load_day_summary(date, is_finished = False)
+    if summary is None:
+        return None
+
+    anomalies = []
+    for (subject, metric), value in sorted(get_series(summary).items()):
+        if len(history.get((subject, metric), [])) < min_history:
+            continue
+
+        anomaly = check_value(value, history[(subject, metric)], metric, threshold, min_change)
+        if anomaly is not None:
+            anomaly.update({'subject': subject, 'metric': metric})
+            anomalies.append(anomaly)
+    return anomalies
+
+# str
+def format_value(metric, value):
+    if metric == 'duration':
+        return '{:.1f}m'.format(value / 60.0)
+    elif metric.endswith('_lines'):
+        return '{:.0f} lines'.format(value)
+    return '{:.0f} bytes'.format(value)
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(prog='test_log_sizes')
+    parser = argparse.ArgumentParser(prog='test_log_sizes', \
+        description="Compares the log sizes, outputs and durations of a day with the previous days")
     parser.add_argument('-d', '--date', help="current date", type=valid_date, default=str(datetime.date.today()))
+    parser.add_argument('-w', '--window', type=int, default=14, help='number of previous days to compare with')
+    parser.add_argument('-t', '--threshold', type=float, default=5.0, \
+        help='number of deviations (scaled MAD) from the median which is an anomaly')
+    parser.add_argument('--min-change', type=float, default=0.15, \
+        help='smallest relative change from the median which is an anomaly')
+    parser.add_argument('--min-history', type=int, default=5, help='number of previous values needed for a check')
     args = parser.parse_args()
 
-    log_sizes_lst = list(get_log_size_for_last_week(args.date))
-    if not log_sizes_lst:
+    anomalies = find_anomalies(args.date, args.window, args.threshold, args.min_change, args.min_history)
+    if anomalies is None:
         print('[!] No log files were found!')
         sys.exit(0)
 
-    if len(log_sizes_lst) < 5:
-        print('[!] Not enough log files are available!')
-        sys.exit(0)
-
-    min_thr, _, max_thr = get_median_thresholds(log_sizes_lst)
-    today_log_size = get_log_size_for_date(args.date)
-    if today_log_size > max_thr or today_log_size < min_thr:
-        print('[!] Log size is below or above threshold:')
-        print('Expected min: {min_thr} < actual: {actual} < max: {max_thr}' \
-            .format(min_thr=min_thr, max_thr=max_thr, actual=today_log_size))
+    if anomalies:
+        print('[!] Log sizes, outputs or durations are out of their usual range:')
+        for anomaly in anomalies:
+            print('  {subject} {metric}: {actual}, median of the last {window} days: {median}{change}'.format(
+                subject=anomaly['subject'], metric=anomaly['metric'], window=args.window,
+                actual=format_value(anomaly['metric'], anomaly['value']),
+                median=format_value(anomaly['metric'], anomaly['median']),
+                change=' ({:+.0%})'.format(anomaly['change']) if anomaly['change'] is not None else ''))
         sys.exit(1)
 
     sys.exit(0)
@@ -6,89 +6,104 @@ import glob
 import re
 import argparse
 
+from analysis import FileIndex, ContentCache
+
+EXTENSIONS = ['sh', 'py', 'erb', 'rb', 'mk', 'sql']
+
+# Bump it when `scan_file` changes, the cached results are thrown away.
+CACHE_VERSION = 1
+
+# A mention is the longest prefix of a path-like word which ends with an extension. Matching
+# the words first keeps it linear: a single regex backtracks on every position of a long word.
+RE_MENTION_WORD = re.compile(r'[a-z0-9\_\*\-\.\\\/]+', re.I)
+RE_MENTION = re.compile(r'.+\.({})'.format('|'.join(EXTENSIONS)), re.I)
+
+# dict<str,list<str>>
+def scan_file(f, content):
+    _, ext = os.path.splitext(f)
+    content = content.replace('$*', '*')
+    requires = []
+
+    if ext == '.sh':
+        content = content.replace('$(pwd)/$(dirname $0)', os.path.dirname(f)) \
+            .replace('$(dirname $0)', os.path.dirname(f)) \
+            .replace('$(pwd)', os.path.dirname(f))
+        content = re.sub(r'\$\((.*?)\)', '*', content)
+        content = re.sub(r'\$\{(.*?)\}', '*', content)
+        content = re.sub(r'\$([^ \/\-]*?)', '*', content)
+
+    if ext == '.rb':
+        for mention in re.findall(r'require_relative "(.*?)"', content, re.I):
+            file_name = '{}.rb'.format(mention) if not mention.endswith('.rb') else mention
+            requires.append(os.path.abspath(os.path.join(os.path.dirname(f), file_name)))
+
+    if ext == '.py':
+        for imports in re.findall(r'import (.*?)\n', content, re.I):
+            for mention in imports.split(','):
+                requires.append(os.path.abspath(os.path.join(os.path.dirname(f), '{}.py'.format(mention.strip()))))
+
+        for level, mention in re.findall(r'from ([\.]*)(.*?) import', content, re.I):
+            rel_file_path = '../'*(len(level)-1) + '{}.py'.format(mention.strip())
+            requires.append(os.path.abspath(os.path.join(os.path.dirname(f), rel_file_path)))
+
+    mentions = set( match.group(0) for match in map(RE_MENTION.match, RE_MENTION_WORD.findall(content)) if match )
+    return {'requires': requires, 'mentions': sorted(mentions)}
+
 class Parser(object):
-    EXTENSIONS = ['sh', 'py', 'erb', 'rb', 'mk', 'sql']
+    EXTENSIONS = EXTENSIONS
 
     # void
-    def __init__(self, directory, start_files_path):
+    def __init__(self, directory, start_files_path, cache_path = None, processes = None):
         self.directory = os.path.abspath(directory)
         self.need_to_check_files_path = set(start_files_path)
         self.used_files_path = set()
-        self.all_files_path = set(self.collect_files())
+        self.index = FileIndex(self.directory, self.EXTENSIONS)
+        self.all_files_path = set(self.index.files)
         self.not_found_mentions = set()
+        self.cache = ContentCache(cache_path, [CACHE_VERSION, self.EXTENSIONS])
+        self.processes = processes
 
     @property
     def unused_files_path(self):
         return self.all_files_path - self.used_files_path
 
+    # set<str>
+    def find_mention(self, f, mention):
+        for base_path in (os.getcwd(), os.path.dirname(f), self.directory):
+            possible_files_path = self.index.glob(os.path.join(base_path, mention))
+            if possible_files_path:
+                return possible_files_path
+
+        self.not_found_mentions.add((f, mention))
+        return set()
+
     def read(self):
+        # Every round scans the files found by the previous one on the pool.
         while len(self.need_to_check_files_path) != 0:
-            f = self.need_to_check_files_path.pop()
-            self.used_files_path.add(f)
+            files_path = self.need_to_check_files_path
+            self.need_to_check_files_path = set()
+            self.used_files_path |= files_path
+            self.cache.update(files_path, scan_file, self.processes)
+
             collected_files_path = set()
+            for f in files_path:
+                result = self.cache.get(f)
+                for file_path in result['requires']:
+                    if file_path not in self.used_files_path and os.path.exists(file_path):
+                        self.need_to_check_files_path.add(file_path)
 
-            with io.open(f, 'r', encoding='utf-8') as fd:
-                _, ext = os.path.splitext(f)
-                content = fd.read() \
-                    .replace('$*', '*')
-
-                if ext == '.sh':
-                    content = content.replace('$(pwd)/$(dirname $0)', os.path.dirname(f)) \
-                        .replace('$(dirname $0)', os.path.dirname(f)) \
-                        .replace('$(pwd)', os.path.dirname(f))
-                    content = re.sub(r'\$\((.*?)\)', '*', content)
-                    content = re.sub(r'\$\{(.*?)\}', '*', content)
-                    content = re.sub(r'\$([^ \/\-]*?)', '*', content)
-
-                if ext == '.rb':
-                    for mention in re.findall(r'require_relative "(.*?)"', content, re.I):
-                        file_name = '{}.rb'.format(mention) if not mention.endswith('.rb') else mention
-                        file_path = os.path.abspath(os.path.join(os.path.dirname(f), file_name))
-                        if os.path.exists(file_path):
-                            self.need_to_check_files_path.add(file_path)
-
-                if ext == '.py':
-                    for imports in re.findall(r'import (.*?)\n', content, re.I):
-                        for mention in imports.split(','):
-                            file_path = os.path.abspath(os.path.join(os.path.dirname(f), '{}.py'.format(mention.strip())))
-                            if os.path.exists(file_path):
-                                self.need_to_check_files_path.add(file_path)
-
-                    for level, mention in re.findall(r'from ([\.]*)(.*?) import', content, re.I):
-                        rel_file_path = '../'*(len(level)-1) + '{}.py'.format(mention.strip())
-                        file_path = os.path.abspath(os.path.join(os.path.dirname(f), rel_file_path))
-                        if os.path.exists(file_path):
-                            self.need_to_check_files_path.add(file_path)
-
-                for mention, ext in set(re.findall(r'([a-z0-9\_\*\-\.\\\/]+\.({}))'.format('|'.join(self.EXTENSIONS)), content, re.I)):
-                    possible_files_path = glob.glob(os.path.abspath(mention))
-                    if possible_files_path:
-                        collected_files_path |= set(possible_files_path)
-                        continue
-
-                    possible_files_path = glob.glob(os.path.abspath(os.path.join(os.path.dirname(f), mention)))
-                    if possible_files_path:
-                        collected_files_path |= set(possible_files_path)
-                        continue
-
-                    possible_files_path = glob.glob(os.path.abspath(os.path.join(self.directory, mention)))
-                    if possible_files_path:
-                        collected_files_path |= set(possible_files_path)
-                        continue
-
-                    self.not_found_mentions.add((f, mention))
+                for mention in result['mentions']:
+                    collected_files_path |= self.find_mention(f, mention)
 
             for file_path in collected_files_path:
                 if file_path.startswith(self.directory) and file_path not in self.used_files_path:
                     self.need_to_check_files_path.add(file_path)
 
+        self.cache.save()
         return self
 
     def collect_files(self):
-        for root, dirs, files in os.walk(self.directory):
-            for f in files:
-                if f.endswith(tuple(self.EXTENSIONS)):
-                    yield os.path.join(root, f)
+        return iter(self.index.files)
 
     def show_recognizable_files(self):
         if not self.not_found_mentions:
@@ -118,9 +133,11 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('files_pattern', nargs='+', help='entry point of files')
     parser.add_argument('-d', '--dir', help='directory to check', required = True)
+    parser.add_argument('--cache', default='logs/unused_files_cache.json', help='cache of the scanned files')
+    parser.add_argument('-j', '--jobs', type=int, help='number of processes, default: number of CPUs')
     args = parser.parse_args()
 
     files_path = map(os.path.abspath, sum(map(glob.glob, sum(map(str.split, args.files_pattern), [])), []))
-    p = Parser(args.dir, files_path).read()
+    p = Parser(args.dir, files_path, args.cache, args.jobs).read()
     p.show_unused_files()
-    sys.exit(min(len(p.unused_files_path),1))
\ No newline at end of file
+    sys.exit(min(len(p.unused_files_path),1))
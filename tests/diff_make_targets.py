@@ -1,8 +1,9 @@
 from __future__ import print_function
-import re
 import sys
 import argparse
 
+from analysis import PatternMatcher
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog='diff_make_targets', \
         description="Compares makefile's targets and returns the unused ones")
@@ -15,16 +16,7 @@ if __name__ == "__main__":
     production_targets = set(map(str.strip, args.production_targets_file.readlines()))
     pattern_targets = set(map(str.strip, args.all_targets_file.readlines())) - production_targets
 
-    for pattern_target in list(pattern_targets):
-        r_pattern = pattern_target.replace('%', '.+')
-        if r_pattern.endswith('/'):
-            r_pattern = r_pattern[:-1]
-        
-        re_target = re.compile(r'^{}$'.format(r_pattern))
-        for prod_target in production_targets:
-            if re_target.match(prod_target):
-                pattern_targets.remove(pattern_target)
-                break
+    pattern_targets -= PatternMatcher(pattern_targets).find_matching(production_targets)
 
     if len(pattern_targets) == 0:
         print("No unused target found")
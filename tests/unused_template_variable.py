@@ -1,62 +1,92 @@
 from __future__ import print_function
-import io
 import os
 import re
 import sys
-import glob
 import shlex
 import argparse
 
+from analysis import ContentCache
+
+COMMAND_PREFIX = 'night-shift/lib/run_sql_template.rb'
+
+# Options of run_sql_template.rb which are not template variables.
+VALUE_OPTIONS = set(['-d', '--dialect', '-c', '--config', '--broker', '--serve', '--pool-size', \
+    '--export', '--chunk-size', '--compress'])
+FLAG_OPTIONS = set(['--csv', '--session', '-nf', '-nl'])
+
+# Ruby code of the templates: the ERB tags and the `#{...}` interpolations.
+RE_ERB_CODE = re.compile(r'<%.*?%>|#\{[^}]*\}', re.S)
+RE_IDENTIFIER = re.compile(r'\w+')
+
+# Bump it when `compile_template` changes, the cached results are thrown away.
+CACHE_VERSION = 1
+
 def get_commands(fd):
-    current_command, concat_next = [], False
-    for line in args.commands_file.readlines():
+    current_command = []
+    for line in fd:
         trimmed_line = line.strip()
-        concat_next = trimmed_line.endswith('\\')
         current_command.append(trimmed_line.strip('\\'))
 
-        if concat_next:
+        if trimmed_line.endswith('\\'):
             continue
 
         yield ' '.join(current_command)
         current_command = []
 
+# tuple<set<str>,list<str>>
 def parse_command(command):
-    attrs = filter(lambda x: x not in ('dialect', 'config', 'csv'), re.findall('--(\w+)', command, re.I))
-    parser = argparse.ArgumentParser()
-    parser.add_argument('-d', '--dialect')
-    parser.add_argument('-c', '--config')
-    parser.add_argument('--csv', action='store_true')
-    for attr in attrs:
-        parser.add_argument('--{}'.format(attr))
-    parser.add_argument('templates', nargs="+")
-    args = parser.parse_args(shlex.split(command)[1:])
-    return set(attrs), args.templates
+    attrs, templates = set(), []
+    tokens = iter(shlex.split(command)[1:])
+    for token in tokens:
+        option, has_value, _ = token.partition('=')
+        if token in FLAG_OPTIONS or option in VALUE_OPTIONS and has_value:
+            continue
+        elif token in VALUE_OPTIONS:
+            next(tokens, None)
+        elif token.startswith('--'):
+            attrs.add(option[2:])
+            if not has_value:
+                next(tokens, None)
+        elif not token.startswith('-'):
+            templates.append(token)
+    return attrs, templates
+
+# list<str>
+def compile_template(path, content):
+    # Every identifier of the Ruby code, a variable is used if it is one of them.
+    return sorted(set( identifier for code in RE_ERB_CODE.findall(content) \
+        for identifier in RE_IDENTIFIER.findall(code) ))
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('commands_file', type=argparse.FileType('r'), help='make -n result file')
+    parser.add_argument('--cache', default='logs/template_index.json', help='compiled template cache')
+    parser.add_argument('-j', '--jobs', type=int, help='number of processes, default: number of CPUs')
     args = parser.parse_args()
 
     warnings, errors = [], []
-    commands = map(lambda x: re.split('\>|\|', x)[0].strip(), filter(lambda x: x.startswith('night-shift/lib/run_sql_template.rb'), get_commands(args.commands_file)))
+    commands = [ re.split(r'\>|\|', x)[0].strip() for x in get_commands(args.commands_file) \
+        if x.startswith(COMMAND_PREFIX) ]
+    parsed_commands = [ parse_command(command) for command in commands ]
 
-    for command in commands:
-        attrs, templates = parse_command(command)
-        founded = set([])
-        if not all(map(os.path.exists, map(os.path.abspath, templates))):
-            warnings.append( ' => SQL template file is not exists at `{}`'.format(template) )
+    # Each template is compiled once, on the pool, and only when its content changed.
+    index = ContentCache(args.cache, CACHE_VERSION)
+    index.update([ os.path.abspath(template) for _, templates in parsed_commands \
+        for template in templates if os.path.exists(os.path.abspath(template)) ], compile_template, args.jobs)
+    index.save()
+
+    for attrs, templates in parsed_commands:
+        missing_templates = [ template for template in templates if not os.path.exists(os.path.abspath(template)) ]
+        if missing_templates:
+            warnings.append( ' => SQL template file is not exists at `{}`'.format(', '.join(missing_templates)) )
             continue
 
+        founded = set()
         for template in templates:
-            with io.open(os.path.abspath(template), 'r', encoding='utf-8') as fd:
-                content = fd.read()
-                for attr in attrs:
-                    res = re.findall('(\<\%\= ' + attr + ' \%\>|\#\{' + attr + '}|\<\%.*' + attr + '.*\%\>)', content)
-                    if res:
-                        founded.add(attr)
+            founded |= attrs & set(index.get(os.path.abspath(template)))
 
         if not attrs.issubset(founded):
-            errors.append( ' => `{}` at `{}`'.format(', '.join(attrs-founded), ' '.join(templates)) )
+            errors.append( ' => `{}` at `{}`'.format(', '.join(sorted(attrs-founded)), ' '.join(templates)) )
 
     if warnings:
         print()
@@ -64,11 +94,11 @@ if __name__ == '__main__':
         print('\n'.join(warnings))
 
     if errors:
-        print
+        print()
         print('Unused template variables were found:')
         print('\n'.join(errors))
         sys.exit(1)
     else:
         print('No unused template variable found.')
 
-    sys.exit(0)
\ No newline at end of file
+    sys.exit(0)
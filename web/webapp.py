@@ -1,18 +1,34 @@
 import os
 import re
 import io
+import sys
+import time
 import datetime
 import argparse
+import threading
 from math import log
 from flask import *
 from functools import wraps
 from dateutil.parser import parse as parse_datetime
 
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'lib'))
+from timing_env import TimingEnvLogReader, normalize_target
+from analytics import AnalyticsStore, get_database_path
+from critical_path import GRAPH_FILE_NAME
+import log_reader
+import log_storage
+
 app  = Flask(__name__)
 
 class Logs(object):
     # extendable menu list
     MENU = []
+    RE_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
 
     # void
     def __init__(self, dir_project, date = None):
@@ -29,10 +45,42 @@ class Logs(object):
 
     # str
     def get_content(self, file_path):
-        if not os.path.exists(file_path):
+        if not file_path or not log_storage.exists(file_path):
+            return None
+
+        with log_storage.open_log(file_path) as fd:
+            return fd.read().decode('utf-8').strip()
+
+    # iter<bytes>
+    def iter_content(self, file_path, start = 0, end = None):
+        with log_storage.open_log(file_path) as fd:
+            for block in log_reader.iter_blocks(fd, start, end):
+                yield block
+
+    # int
+    def get_tail_offset(self, file_path, lines = None, size = None):
+        if size is not None:
+            return max(0, log_storage.get_size(file_path) - size)
+
+        with log_storage.open_log(file_path) as fd:
+            return log_reader.find_tail_offset(fd, lines)
+
+    # tuple<int,int>
+    def parse_range_header(self, range_header, size):
+        match = self.RE_RANGE.match(range_header or '')
+        if not match or match.groups() == ('', ''):
             return None
 
-        return io.open(file_path, 'r', encoding='utf-8').read().strip()
+        first, last = match.groups()
+        if not first:
+            start, end = max(0, size - int(last)), size
+        else:
+            start, end = int(first), min(size, int(last) + 1) if last else size
+
+        if start >= end:
+            raise ValueError('Range is not satisfiable: {}'.format(range_header))
+
+        return start, end
 
     # list<str>
     def find_available_log_dates(self):
@@ -49,44 +97,26 @@ class Logs(object):
             else []
 
 class TrackingShellLog(Logs):
-    # str
-    def get_timing_env_log_content(self):
+    # parsed state of every timing env log, shared between requests
+    TIMING_ENV_READERS = {}
+    TIMING_ENV_READERS_LOCK = threading.Lock()
+    # thresholds of the dominant resource of a command
+    CPU_BOUND_RATIO = 0.5
+    IO_BOUND_BYTES_PER_SECOND = 10 * 1024 * 1024
+    MEMORY_BOUND_RSS_KB = 2 * 1024 * 1024
+
+    # TimingEnvLogReader
+    def get_timing_env_log_reader(self):
         path = os.path.join(self.dir_date, 'timing_env.log')
-        if os.path.exists(path):
-            return io.open(path, 'r', encoding='utf-8').read()
-        return u''
+        with self.TIMING_ENV_READERS_LOCK:
+            if path not in self.TIMING_ENV_READERS:
+                self.TIMING_ENV_READERS[path] = TimingEnvLogReader(path)
+            return self.TIMING_ENV_READERS[path]
 
     # tupe<list<dict>,list<str>>
     def find_timing_env_commands(self):
-        content = self.get_timing_env_log_content()
-        if not content: return [], set(['Timing env log is not found!'])
-
-        commands, ordered_commands, errors = {}, [], set()
-        for line in content.split('\n'):
-            try:
-                data = json.loads(line)
-            except:
-                continue
-
-            cmd_hash_key = (data['command'],data['unique_nr'])
-            if cmd_hash_key not in commands.keys() and data['tag'] == 'BEGIN':
-                commands[cmd_hash_key] = data
-                commands[cmd_hash_key]['tags'] = [data['tag']]
-                ordered_commands.append(commands[cmd_hash_key])
-
-            elif cmd_hash_key in commands.keys() and data['tag'] in commands[cmd_hash_key]['tags']:
-                errors.add('Found duplicated command: {}'.format(data['command']))
-
-            elif cmd_hash_key in commands.keys() and data['tag'] == 'END':
-                commands[cmd_hash_key].update(data)
-                commands[cmd_hash_key]['tags'].append(data['tag'])
-
-            else:
-                errors.add('Unknown error: {}'.format(data['command']))
-
-        for command in ordered_commands:
-            command['started_at'] = parse_datetime(command['started_at'])
-            if 'finished_at' in command: command['finished_at'] = parse_datetime(command['finished_at'])
+        ordered_commands, errors = self.get_timing_env_log_reader().read()
+        if not ordered_commands: return [], set(['Timing env log is not found!'])
 
         return ordered_commands, errors
 
@@ -105,22 +135,96 @@ class TrackingShellLog(Logs):
         ordered_commands, errors = self.find_timing_env_commands()
         if not ordered_commands: return ordered_commands, errors
 
-        first_command_started_at, attempt_dict = ordered_commands[0]['started_at'], {}
+        now = datetime.datetime.now()
         for cmd_dict in ordered_commands:
-            started_at, finished_at = cmd_dict.get('started_at'), cmd_dict.get('finished_at', datetime.datetime.now())
-            cmd_dict['date'] = started_at.date()
-            cmd_dict['status'] = self.get_timing_env_command_status(cmd_dict)
-            cmd_dict['waited'] = (started_at-first_command_started_at).total_seconds() / 60
-            cmd_dict['length'] = (finished_at-started_at).total_seconds() / 60
-            cmd_dict['log_id'] = self.get_log_id(cmd_dict['target'])
-            attempt_dict.setdefault((cmd_dict['target'],cmd_dict['command']), 0)
-            attempt_dict[(cmd_dict['target'],cmd_dict['command'])] += 1
-            cmd_dict['attempt_nr'] = attempt_dict[(cmd_dict['target'],cmd_dict['command'])]
+            self.update_timing_env_command_dict(cmd_dict, now)
 
         return ordered_commands, errors
 
+    # str
+    def get_timing_env_command_usage(self, cmd_dict):
+        if 'cpu_user' not in cmd_dict:
+            return None
+
+        seconds = max(cmd_dict['length'] * 60, 0.001)
+        io_bytes = cmd_dict.get('read_bytes', 0) + cmd_dict.get('write_bytes', 0)
+        if cmd_dict['max_rss_kb'] >= self.MEMORY_BOUND_RSS_KB:
+            return 'memory'
+        elif cmd_dict['cpu_user'] / seconds >= self.CPU_BOUND_RATIO:
+            return 'cpu'
+        elif io_bytes / seconds >= self.IO_BOUND_BYTES_PER_SECOND:
+            # The system CPU time of these goes to the i/o mostly.
+            return 'io'
+        elif (cmd_dict['cpu_user'] + cmd_dict['cpu_sys']) / seconds >= self.CPU_BOUND_RATIO:
+            return 'cpu'
+
+        # Neither CPU nor disk, e.g. waiting on a database.
+        return 'wait'
+
+    # str
+    def get_timing_env_command_usage_summary(self, cmd_dict):
+        summary = []
+        if 'cpu_user' in cmd_dict:
+            summary.append('cpu: {:.1f}s user, {:.1f}s sys, max rss: {}, read: {}, written: {}'.format(
+                cmd_dict['cpu_user'], cmd_dict['cpu_sys'], filesize(cmd_dict['max_rss_kb'], 1),
+                filesize(cmd_dict.get('read_bytes', 0)), filesize(cmd_dict.get('write_bytes', 0))))
+
+        metrics = cmd_dict.get('metrics', {})
+        if 'rows_per_second' in metrics:
+            summary.append('result: {} rows, {} in {:.1f}s ({:.0f} rows/s, {}/s)'.format(
+                metrics['rows'], filesize(metrics['bytes']), metrics['seconds'],
+                metrics['rows_per_second'], filesize(metrics['bytes_per_second'])))
+
+        return ', '.join(summary)
+
+    # void
+    def update_timing_env_command_dict(self, cmd_dict, now):
+        cmd_dict['status'] = self.get_timing_env_command_status(cmd_dict)
+        if 'length' not in cmd_dict:
+            cmd_dict['length'] = (now-cmd_dict['started_at']).total_seconds() / 60
+        cmd_dict['log_id'] = self.get_log_id(cmd_dict['target'])
+        cmd_dict['usage'] = self.get_timing_env_command_usage(cmd_dict)
+        cmd_dict['usage_summary'] = self.get_timing_env_command_usage_summary(cmd_dict)
+
+    # str
+    def get_profile_path(self, file_name):
+        path = os.path.join(self.dir_date, 'profiles', file_name)
+        if os.path.basename(file_name) != file_name or not os.path.isfile(path):
+            return None
+        return path
+
+    # dict
+    def get_make_graph(self, commands):
+        try:
+            with io.open(os.path.join(self.dir_date, GRAPH_FILE_NAME), 'r', encoding='utf-8') as fd:
+                make_graph = json.load(fd)
+        except (IOError, ValueError):
+            return None
+
+        # The utilization is drawn on the same minute scale as the commands.
+        utilization = make_graph['utilization']
+        utilization['offset'] = (parse_datetime(utilization['started_at']) - commands[0]['started_at']) \
+            .total_seconds() / 60 if commands and utilization.get('started_at') else 0
+        make_graph['critical_targets'] = set(make_graph['critical_path'])
+        return make_graph
+
+    # tuple<int,int,list<dict>>
+    def get_timing_env_changes(self, generation = None, position = 0):
+        generation, position, changes = self.get_timing_env_log_reader().read_changes(generation, position)
+
+        now = datetime.datetime.now()
+        for cmd_dict in changes:
+            self.update_timing_env_command_dict(cmd_dict, now)
+            cmd_dict['date'] = cmd_dict['date'].isoformat()
+            for key in ('started_at', 'finished_at'):
+                if key in cmd_dict: cmd_dict[key] = cmd_dict[key].isoformat()
+
+        return generation, position, changes
+
 class TargetLogs(Logs):
     TARGET_LOG_IGNORE = ['timing_env','attempt','trackingshell']
+    TARGET_LOG_INDEX = 'target_logs.idx'
+    RE_TARGET_MARKER = re.compile(br'\[tracking_shell [^\]]+\] Working on target (\S+) attempt', re.I)
 
     # str
     def get_path_by_log_id(self, log_id):
@@ -135,9 +239,9 @@ class TargetLogs(Logs):
         if not os.path.exists(self.dir_date):
             return []
 
-        return [ os.path.join(self.dir_date, f) \
-            for f in os.listdir(self.dir_date) \
-            if f.endswith('.log') and not f.startswith(tuple(self.TARGET_LOG_IGNORE)) ]
+        return [ file_path \
+            for file_path in log_storage.list_logs(self.dir_date) \
+            if not os.path.basename(file_path).startswith(tuple(self.TARGET_LOG_IGNORE)) ]
 
     # dict
     def get_tracking_shell_log_content(self):
@@ -146,39 +250,109 @@ class TargetLogs(Logs):
         return self.get_target_log_dict(ts_log_path, return_content = True)
 
     # bool
-    def is_target_log_succeed(self, content):
-        tracking_shell_lines = re.findall(r'\[tracking_shell [^\]]+\] Working on target (\S+) attempt', content, re.I)
-        if not tracking_shell_lines:
+    def is_target_built(self, target):
+        if not target:
             return False
 
-        target_file_name = os.path.join(
-            self.dir_project,
-            tracking_shell_lines[-1]
-        )
-        if not target_file_name:
-            return False
+        return os.path.exists(os.path.join(self.dir_project, target))
 
-        return os.path.exists(target_file_name)
+    # str
+    def find_last_target_marker(self, fd, start = 0, end = None):
+        match = log_reader.search_last_line(fd, self.RE_TARGET_MARKER, start, end)
+        return match.group(1).decode('utf-8', 'replace') if match else None
 
     # dict
     def get_target_log_dict(self, file_path, return_content = False):
         _, file_name = os.path.split(file_path)
         name, _ = os.path.splitext(file_name)
-        content = self.get_content(file_path)
+        stat = log_storage.stat(file_path)
+        entry = self.scan_target_log(file_path, stat)
 
         return {
             'id': self.get_log_id(name),
             'name': name,
-            'size': os.path.getsize(file_path),
-            'lines': len(content.split('\n')),
-            'success': self.is_target_log_succeed(content),
-            'content': content if return_content else None
+            'size': entry['size'],
+            'lines': self.get_target_log_lines(entry),
+            'success': self.is_target_built(entry['target']),
+            'content': self.get_content(file_path) if return_content else None
         }
 
+    # str
+    def get_target_log_index_path(self):
+        return os.path.join(self.dir_date, self.TARGET_LOG_INDEX)
+
+    # dict
+    def load_target_log_index(self):
+        try:
+            with io.open(self.get_target_log_index_path(), 'r', encoding='utf-8') as fd:
+                return json.load(fd)
+        except (IOError, ValueError):
+            return {}
+
+    # void
+    def save_target_log_index(self, index):
+        path = self.get_target_log_index_path()
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.current_thread().ident)
+        try:
+            with io.open(tmp_path, 'wb') as fd:
+                fd.write(json.dumps(index).encode('utf-8'))
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            app.logger.warning('Could not write target log index `%s`', path)
+
+    # dict
+    def scan_target_log(self, file_path, stat, entry = None):
+        if not entry or entry['inode'] != stat.st_ino or stat.st_size < entry['offset']:
+            entry = {'inode': stat.st_ino, 'offset': 0, 'newlines': 0, 'target': None}
+
+        # Only complete lines are indexed, the rest is scanned on the next change.
+        with log_storage.open_log(file_path) as fd:
+            last_newline = log_reader.find_last_newline(fd, entry['offset'], stat.st_size)
+            if last_newline != -1:
+                end = last_newline + 1
+                entry['target'] = self.find_last_target_marker(fd, entry['offset'], end) \
+                    or entry['target']
+                entry['newlines'] += log_reader.count_newlines(fd, entry['offset'], end)
+                entry['offset'] = end
+
+        entry.update({'size': stat.st_size, 'mtime': stat.st_mtime})
+        return entry
+
+    # int
+    def get_target_log_lines(self, entry):
+        return entry['newlines'] + (1 if entry['size'] > entry['offset'] else 0)
+
     # list<dict>
     def get_target_logs_dict(self):
+        index, updated_index = self.load_target_log_index(), {}
+        target_logs = []
         for file_path in self.find_target_log_files():
-            yield self.get_target_log_dict(file_path)
+            _, file_name = os.path.split(file_path)
+            name, _ = os.path.splitext(file_name)
+            try:
+                stat = log_storage.stat(file_path)
+            except OSError:
+                # Removed (or compressed) since it was listed.
+                continue
+
+            entry = index.get(file_name)
+            if not entry or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+                entry = self.scan_target_log(file_path, stat, entry)
+            updated_index[file_name] = entry
+
+            target_logs.append({
+                'id': self.get_log_id(name),
+                'name': name,
+                'size': entry['size'],
+                'lines': self.get_target_log_lines(entry),
+                'success': self.is_target_built(entry['target']),
+                'content': None
+            })
+
+        if updated_index != index:
+            self.save_target_log_index(updated_index)
+
+        return target_logs
 
     # list<dict>
     def get_sorted_target_logs_dict(self):
@@ -188,6 +362,361 @@ class TargetLogs(Logs):
         return sorted(logs_sorted_by_size, \
             key = lambda x: x['success'])
 
+class History(Logs):
+    # days of the recent period compared with the rest
+    RECENT_DAYS = 7
+
+    # AnalyticsStore
+    def get_analytics_store(self):
+        path = get_database_path(self.dir_logs)
+        if not os.path.exists(path):
+            return None
+
+        return AnalyticsStore(path)
+
+    # datetime.date
+    def get_since(self, days):
+        return self.date - datetime.timedelta(days=days-1)
+
+    # list<dict>
+    def get_target_stats(self, days):
+        store = self.get_analytics_store()
+        if store is None: return []
+
+        with store:
+            target_stats = store.get_target_stats(self.get_since(days), self.get_since(self.RECENT_DAYS))
+
+        # The biggest regressions first.
+        return sorted(target_stats, key = lambda x: (x['change'] is None, -(x['change'] or 0)))
+
+    # tuple<list<dict>,dict>
+    def get_duration_history(self, target, days):
+        store = self.get_analytics_store()
+        if store is None: return [], {}
+
+        with store:
+            history = store.get_duration_history(target, self.get_since(days))
+            stats = store.get_duration_stats([ run['duration'] for run in history \
+                if run['exit_code'] == 0 and run['duration'] is not None ])
+            return history, stats
+
+class LogWatcher(object):
+    # seconds between two scans of the log directory
+    INTERVAL = 2
+    HEARTBEAT = 15
+    WATCHERS = {}
+    WATCHERS_LOCK = threading.Lock()
+
+    # LogWatcher
+    @classmethod
+    def get(cls, dir_project, date):
+        with cls.WATCHERS_LOCK:
+            if (dir_project, date) not in cls.WATCHERS:
+                cls.WATCHERS[(dir_project, date)] = cls(dir_project, date)
+            return cls.WATCHERS[(dir_project, date)]
+
+    # void
+    def __init__(self, dir_project, date):
+        self.timing_env = TrackingShellLog(dir_project, date)
+        self.target_logs = TargetLogs(dir_project, date)
+        self.lock = threading.Lock()
+        self.scan_lock = threading.Lock()
+        self.subscribers = []
+        self.thread = None
+        self.generation, self.position = None, 0
+        self.target_log_dicts = {}
+
+    # Queue
+    def subscribe(self):
+        queue = Queue()
+        with self.lock:
+            self.subscribers.append(queue)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+        return queue
+
+    # void
+    def unsubscribe(self, queue):
+        with self.lock:
+            self.subscribers.remove(queue)
+
+    # void
+    def publish(self, event, data):
+        with self.lock:
+            for queue in self.subscribers:
+                queue.put((event, data))
+
+    # void
+    def run(self):
+        while True:
+            # One thread scans the directory for every watcher of the same date.
+            with self.lock:
+                if not self.subscribers:
+                    self.thread = None
+                    return
+
+            try:
+                with self.scan_lock:
+                    self.scan()
+            except Exception:
+                app.logger.exception('Could not scan `%s`', self.target_logs.dir_date)
+
+            time.sleep(self.INTERVAL)
+
+    # void
+    def scan(self):
+        # The first scan only builds the state, subscribers catch up on their own.
+        is_first_scan = self.generation is None
+
+        generation, self.position, changes = self.timing_env.get_timing_env_changes(self.generation, self.position)
+        if not is_first_scan and generation != self.generation:
+            self.publish('reset', {})
+        elif not is_first_scan and changes:
+            self.publish('commands', changes)
+        self.generation = generation
+
+        target_log_dicts = dict( (log['id'], log) for log in self.target_logs.get_target_logs_dict() )
+        changed_target_logs = [ log for log_id, log in target_log_dicts.items() \
+            if self.target_log_dicts.get(log_id) != log ]
+        self.target_log_dicts = target_log_dicts
+        if not is_first_scan and changed_target_logs:
+            self.publish('target_logs', changed_target_logs)
+
+    # tuple<Queue,list<str>>
+    def subscribe_with_catch_up(self, topics, generation = None, position = None):
+        # No scan can run between the catch-up and the subscription, so the published
+        # changes start where the catch-up ended (or repeat a few of them).
+        with self.scan_lock:
+            if self.generation is None:
+                self.scan()
+
+            events = []
+            if 'commands' in topics and position is not None:
+                current_generation, _, changes = self.timing_env.get_timing_env_changes(generation, position)
+                if current_generation != generation:
+                    events.append(self.format_event('reset', {}))
+                elif changes:
+                    events.append(self.format_event('commands', changes))
+
+            if 'target_logs' in topics:
+                events.append(self.format_event('target_logs', list(self.target_log_dicts.values())))
+
+            return self.subscribe(), events
+
+    # iter<str>
+    def iter_events(self, topics, generation = None, position = None):
+        queue, events = self.subscribe_with_catch_up(topics, generation, position)
+        try:
+            for event in events:
+                yield event
+
+            while True:
+                try:
+                    event, data = queue.get(timeout=self.HEARTBEAT)
+                except Empty:
+                    yield ': heartbeat\n\n'
+                    continue
+
+                if event == 'reset' or event in topics:
+                    yield self.format_event(event, data)
+
+        finally:
+            self.unsubscribe(queue)
+
+    # str
+    def format_event(self, event, data):
+        return 'event: {}\ndata: {}\n\n'.format(event, json.dumps(data))
+
+class RunMetrics(object):
+    # upper bounds of the duration histogram buckets in seconds
+    DURATION_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200, 14400)
+    # seconds a rendered exposition is served again, scrapers can not make it work more
+    MIN_INTERVAL = 1
+    CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+    AGGREGATES = {}
+    AGGREGATES_LOCK = threading.Lock()
+
+    # RunMetrics
+    @classmethod
+    def get(cls, dir_project, date):
+        with cls.AGGREGATES_LOCK:
+            if (dir_project, date) not in cls.AGGREGATES:
+                # The runs of today are scraped again and again, an older date only now and then.
+                today = str(datetime.date.today())
+                for key in [ key for key in cls.AGGREGATES if key[1] != today ]:
+                    del cls.AGGREGATES[key]
+                cls.AGGREGATES[(dir_project, date)] = cls(dir_project, date)
+            return cls.AGGREGATES[(dir_project, date)]
+
+    # void
+    def __init__(self, dir_project, date):
+        self.timing_env = TrackingShellLog(dir_project, date)
+        self.lock = threading.Lock()
+        self.rendered, self.rendered_at = None, 0
+        self.reset()
+
+    # void
+    def reset(self):
+        self.generation, self.position = None, 0
+        # last run of every (target, command) of the make level, and the status of the targets
+        self.last_runs = {}
+        self.target_runs = {}
+        self.target_statuses = {}
+        self.observed = set()
+        self.durations = {}
+        # Only the output multiplexer (or the executor) counts the output of the recipes.
+        self.output_bytes = None
+
+    # void
+    def update(self):
+        # Only the records appended since the last scrape are applied.
+        generation, position, changes = self.timing_env.get_timing_env_log_reader() \
+            .read_changes(self.generation, self.position)
+        if generation != self.generation:
+            # Rotated log, the changes start from the beginning again.
+            self.reset()
+
+        self.generation, self.position = generation, position
+        for cmd_dict in changes:
+            if cmd_dict.get('has_make_level'):
+                self.apply(cmd_dict)
+
+    # void
+    def apply(self, cmd_dict):
+        key = (cmd_dict['target'], cmd_dict['command'])
+        last_run = self.last_runs.get(key)
+        if last_run is None or last_run['started_at'] <= cmd_dict['started_at']:
+            self.last_runs[key] = cmd_dict
+            self.target_runs.setdefault(cmd_dict['target'], set()).add(key)
+            self.update_target_status(cmd_dict['target'])
+
+        # Every finished run is observed once, even if it was retried since.
+        unique_key = (cmd_dict['command'], cmd_dict['unique_nr'])
+        if 'finished_at' in cmd_dict and unique_key not in self.observed:
+            self.observed.add(unique_key)
+            self.observe(normalize_target(cmd_dict['target'], self.timing_env.date), cmd_dict['length'] * 60)
+            if 'output_bytes' in cmd_dict:
+                self.output_bytes = (self.output_bytes or 0) + cmd_dict['output_bytes']
+
+    # void
+    def update_target_status(self, target):
+        statuses = set( self.get_run_status(self.last_runs[key]) for key in self.target_runs[target] )
+        for status in ('running', 'failed', 'succeeded'):
+            if status in statuses:
+                self.target_statuses[target] = status
+                return
+
+    # str
+    def get_run_status(self, cmd_dict):
+        if 'finished_at' not in cmd_dict:
+            return 'running'
+        return 'succeeded' if cmd_dict['exit_code'] == 0 else 'failed'
+
+    # void
+    def observe(self, target, seconds):
+        histogram = self.durations.setdefault(target, {'buckets': [0] * len(self.DURATION_BUCKETS), \
+            'count': 0, 'sum': 0.0})
+        for i, bound in enumerate(self.DURATION_BUCKETS):
+            if seconds <= bound:
+                histogram['buckets'][i] += 1
+        histogram['count'] += 1
+        histogram['sum'] += seconds
+
+    # dict<str,int>
+    def get_target_counts(self):
+        # A run without an end is only running on the current day, it was killed otherwise.
+        is_live = self.timing_env.date == datetime.date.today()
+        counts = {'running': 0, 'failed': 0, 'succeeded': 0}
+        for status in self.target_statuses.values():
+            counts['failed' if status == 'running' and not is_live else status] += 1
+        return counts
+
+    # int
+    def get_active_slots(self):
+        if self.timing_env.date != datetime.date.today():
+            return 0
+        return sum( 1 for cmd_dict in self.last_runs.values() if 'finished_at' not in cmd_dict )
+
+    # tuple<int,int>
+    def get_log_sizes(self):
+        # Only the sizes of the files, the logs are never read.
+        if not os.path.isdir(self.timing_env.dir_date):
+            return 0, 0
+
+        attempts, log_bytes = 0, 0
+        for path in log_storage.list_logs(self.timing_env.dir_date):
+            if os.path.basename(path).startswith('attempt-'):
+                attempts += 1
+            try:
+                log_bytes += log_storage.get_size(path)
+            except OSError:
+                continue
+        return attempts, log_bytes
+
+    # str
+    def format_labels(self, **labels):
+        if not labels:
+            return ''
+        return '{{{}}}'.format(','.join( '{}="{}"'.format(name, str(value) \
+            .replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) \
+            for name, value in sorted(labels.items()) ))
+
+    # str
+    def format_value(self, value):
+        return repr(float(value)) if isinstance(value, float) else str(value)
+
+    # str
+    def render(self):
+        lines = []
+        def add_family(name, metric_type, help_text):
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            lines.append('# HELP {} {}'.format(name, help_text))
+        def add_sample(name, value, **labels):
+            lines.append('{}{} {}'.format(name, self.format_labels(**labels), self.format_value(value)))
+
+        attempts, log_bytes = self.get_log_sizes()
+
+        add_family('night_shift_run', 'info', 'Date of the run.')
+        add_sample('night_shift_run_info', 1, date=self.timing_env.date_str)
+
+        add_family('night_shift_targets', 'gauge', 'Targets by the status of their last run.')
+        for status, count in sorted(self.get_target_counts().items()):
+            add_sample('night_shift_targets', count, status=status)
+
+        add_family('night_shift_attempts', 'gauge', 'Attempts of run_workflow.sh.')
+        add_sample('night_shift_attempts', attempts)
+
+        add_family('night_shift_active_slots', 'gauge', 'Recipes running at the same time.')
+        add_sample('night_shift_active_slots', self.get_active_slots())
+
+        add_family('night_shift_log_bytes', 'gauge', 'Size of the logs.')
+        add_sample('night_shift_log_bytes', log_bytes)
+
+        if self.output_bytes is not None:
+            add_family('night_shift_output_bytes', 'counter', 'Output of the finished recipes.')
+            add_sample('night_shift_output_bytes_total', self.output_bytes)
+
+        add_family('night_shift_target_duration_seconds', 'histogram', 'Durations of the finished recipes.')
+        for target, histogram in sorted(self.durations.items()):
+            for bound, count in zip(self.DURATION_BUCKETS, histogram['buckets']):
+                add_sample('night_shift_target_duration_seconds_bucket', count, target=target, le=float(bound))
+            add_sample('night_shift_target_duration_seconds_bucket', histogram['count'], target=target, le='+Inf')
+            add_sample('night_shift_target_duration_seconds_count', histogram['count'], target=target)
+            add_sample('night_shift_target_duration_seconds_sum', round(histogram['sum'], 3), target=target)
+
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    # str
+    def get_exposition(self):
+        with self.lock:
+            if self.rendered is None or time.time() - self.rendered_at >= self.MIN_INTERVAL:
+                self.update()
+                self.rendered, self.rendered_at = self.render(), time.time()
+            return self.rendered
+
 # str
 def filesize(n,pow=0,b=1024,u='B',pre=['']+[p+'i'for p in'KMGTPEZY']):
     pow,n=min(int(log(max(n*b**pow,1),b)),len(pre)-1),n*b**pow
@@ -224,7 +753,48 @@ class resolve(object):
 @app.route('/download/<date>/<log_id>')
 @resolve(TargetLogs)
 def download(ns, log_id):
-    return ns.get_content(ns.get_path_by_log_id(log_id))
+    file_path = ns.get_path_by_log_id(log_id)
+    if not file_path: abort(404)
+
+    size = log_storage.get_size(file_path)
+    headers = {'Accept-Ranges': 'bytes'}
+    try:
+        content_range = ns.parse_range_header(request.headers.get('Range'), size)
+    except ValueError:
+        headers['Content-Range'] = 'bytes */{}'.format(size)
+        return Response(status=416, headers=headers)
+
+    start, end = content_range or (0, size)
+    headers['Content-Length'] = str(end - start)
+    if content_range:
+        headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end - 1, size)
+
+    return Response(ns.iter_content(file_path, start, end), status=206 if content_range else 200, \
+        headers=headers, mimetype='text/plain')
+
+@app.route('/tail/<date>/<log_id>')
+@resolve(TargetLogs)
+def tail(ns, log_id):
+    file_path = ns.get_path_by_log_id(log_id)
+    if not file_path: abort(404)
+
+    size = request.args.get('bytes', type=int)
+    lines = request.args.get('lines', default=1000, type=int)
+    start = ns.get_tail_offset(file_path, lines = lines, size = size)
+
+    return Response(ns.iter_content(file_path, start), \
+        headers={'X-Tail-Offset': str(start)}, mimetype='text/plain')
+
+@app.route('/profile/<date>/<file_name>')
+@resolve(TrackingShellLog)
+def profile(ns, file_name):
+    file_path = ns.get_profile_path(file_name)
+    if not file_path: abort(404)
+
+    # The pstats dumps are for `python -m pstats` or snakeviz, the rest is text.
+    if file_name.endswith('.prof'):
+        return send_file(file_path, mimetype='application/octet-stream', as_attachment=True)
+    return send_file(file_path, mimetype='text/plain')
 
 @app.route("/")
 @app.route("/flow")
@@ -235,6 +805,7 @@ def flow(ns, log_id = None):
     return {
         'target_logs': ns.get_sorted_target_logs_dict(),
         'log_id': log_id,
+        'live': ns.date == datetime.date.today(),
         'ts': ns.get_tracking_shell_log_content()
     }
 
@@ -242,8 +813,53 @@ def flow(ns, log_id = None):
 @app.route("/gantt/<date>")
 @resolve(TrackingShellLog)
 def gantt(ns):
+    # Taken before the snapshot, so the live updates can only repeat changes.
+    generation, position = ns.get_timing_env_log_reader().get_position()
     commands, _ = ns.get_timing_env_commands_dict()
-    return {'commands': commands}
+    return {
+        'commands': commands,
+        'make_graph': ns.get_make_graph(commands),
+        'live': ns.date == datetime.date.today(),
+        'generation': generation,
+        'position': position
+    }
+
+@app.route("/history")
+@app.route("/history/<date>")
+@resolve(History)
+def history(ns):
+    target = request.args.get('target')
+    days = request.args.get('days', default=90, type=int)
+    history, stats = ns.get_duration_history(target, days) if target else ([], {})
+
+    return {
+        'target': target,
+        'days': days,
+        'has_store': os.path.exists(get_database_path(ns.dir_logs)),
+        'targets': ns.get_target_stats(days) if not target else [],
+        'history': history,
+        'max_duration': max([ run['duration'] or 0 for run in history ] or [0]),
+        'stats': stats
+    }
+
+@app.route("/events")
+@app.route("/events/<date>")
+@resolve(Logs)
+def events(ns):
+    watcher = LogWatcher.get(ns.dir_project, ns.date_str)
+    topics = request.args.get('topics', 'commands,target_logs').split(',')
+    generation = request.args.get('generation', type=int)
+    position = request.args.get('position', type=int)
+
+    return Response(stream_with_context(watcher.iter_events(topics, generation, position)), \
+        headers={'Cache-Control': 'no-cache'}, mimetype='text/event-stream')
+
+@app.route("/metrics")
+@app.route("/metrics/<date>")
+@resolve(Logs)
+def metrics(ns):
+    exposition = RunMetrics.get(ns.dir_project, ns.date_str).get_exposition()
+    return Response(exposition, headers={'Cache-Control': 'no-cache'}, content_type=RunMetrics.CONTENT_TYPE)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()